@@ -0,0 +1,168 @@
+from datetime import datetime, timedelta
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import date_helper
+import metrics
+
+
+def merge_months(infos: Iterable[dict]) -> dict:
+    """
+    Merges month responses of a camp without copying them. Returns:
+    - campsites: campsite_id -> site dict of the first month the site is in, read only, for the metadata
+    - availabilities: campsite_id -> {day offset from first_day: status} of all the months
+    - first_day, days: the first day and the number of days covered
+    - count: number of campsites
+    """
+    campsites: Dict[str, dict] = {}
+    site_availabilities: Dict[str, List[dict]] = {}
+    for info in infos:
+        for campsite_id, site in info["campsites"].items():
+            if campsite_id not in campsites:
+                campsites[campsite_id] = site
+                site_availabilities[campsite_id] = []
+            site_availabilities[campsite_id].append(site["availabilities"])
+
+    # Every date string is parsed once per camp, not once per site
+    dates = set()
+    for availabilities_list in site_availabilities.values():
+        for availabilities in availabilities_list:
+            dates.update(availabilities)
+    parsed = {date: date_helper.date_from_str(date) for date in dates}
+    first_day = min(parsed.values()) if parsed else None
+    offsets = {date: (day - first_day).days for date, day in parsed.items()}
+
+    availabilities = {}
+    for campsite_id, availabilities_list in site_availabilities.items():
+        availabilities[campsite_id] = {offsets[date]: status
+                                       for month_availabilities in availabilities_list
+                                       for date, status in month_availabilities.items()}
+    return {
+        "campsites": campsites,
+        "availabilities": availabilities,
+        "first_day": first_day,
+        "days": max(offsets.values()) + 1 if offsets else 0,
+        "count": len(campsites),
+    }
+
+
+class AvailabilityMatrix:
+    """
+    Availability of all the campsites of a camp decoded once into a sites x days boolean matrix,
+    so any date range is checked for all the sites with a single column slice.
+    """
+    AVAILABLE = "Available"
+
+    def __init__(self, sites: List[dict], first_day: Optional[datetime], available: np.ndarray):
+        self.sites = sites
+        self.first_day = first_day
+        self.available = available
+        self.use_types = np.array([site["type_of_use"] for site in sites], dtype=object)
+        self.campsite_types = np.array(
+            [site["campsite_type"].upper().replace(" ", "_") for site in sites], dtype=object)
+
+    @property
+    def count(self) -> int:
+        return len(self.sites)
+
+    @classmethod
+    def from_months(cls, infos: Iterable[dict]) -> "AvailabilityMatrix":
+        """ Builds the matrix from month responses of a camp, responses are not modified. """
+        return cls.from_merged(merge_months(infos))
+
+    @classmethod
+    def from_merged(cls, merged: dict) -> "AvailabilityMatrix":
+        """ Builds the matrix from merge_months result. """
+        sites = list(merged["campsites"].values())
+        available = np.zeros((len(sites), merged["days"]), dtype=bool)
+        for row, availabilities in enumerate(merged["availabilities"].values()):
+            available[row, [day for day, status in availabilities.items() if status == cls.AVAILABLE]] = True
+        return cls(sites, merged["first_day"], available)
+
+    @classmethod
+    def by_camp(cls, months_info: Dict[Tuple[Hashable, datetime], dict],
+                previous: Optional[Dict[Hashable, Tuple[List[dict], "AvailabilityMatrix"]]] = None
+                ) -> Dict[Hashable, "AvailabilityMatrix"]:
+        """
+        Builds a matrix per camp out of all the fetched months of the camp.
+        A camp with a failed month gets the exception of that month instead of the matrix.
+        previous keeps camp_id -> (months, matrix) between calls: a camp whose months are the very
+        same objects as the last time (answered from the response cache) keeps its matrix.
+        """
+        camps_months: Dict[Hashable, List[dict]] = {}
+        for (camp_id, _), info in sorted(months_info.items(), key=lambda x: x[0]):
+            camps_months.setdefault(camp_id, []).append(info)
+        ret = {camp_id: cls.for_camp(camp_id, infos, previous) for camp_id, infos in camps_months.items()}
+        if previous is not None:
+            for camp_id in set(previous) - set(camps_months):
+                del previous[camp_id]
+        return ret
+
+    @classmethod
+    def for_camp(cls, camp_id: Hashable, infos: List[dict],
+                 previous: Optional[Dict[Hashable, Tuple[List[dict], "AvailabilityMatrix"]]] = None):
+        """
+        Same as by_camp for the months of one camp, in order, returns the matrix or the exception
+        of a failed month. Camps missing are not dropped from previous.
+        """
+        errors = [x for x in infos if isinstance(x, Exception)]
+        if errors:
+            return errors[0]
+        if previous is not None:
+            last_infos, matrix = previous.get(camp_id, ((), None))
+            if len(last_infos) == len(infos) and all(a is b for a, b in zip(last_infos, infos)):
+                metrics.CACHE_REQUESTS.inc(cache="matrix", result="hit")
+                return matrix
+            metrics.CACHE_REQUESTS.inc(cache="matrix", result="miss")
+        matrix = cls.from_months(infos)
+        if previous is not None:
+            previous[camp_id] = (infos, matrix)
+        return matrix
+
+    def _columns(self, first_night: datetime, last_night: datetime) -> Optional[Tuple[int, int]]:
+        """ Returns the column slice of first_night..last_night, None if not all of them are known. """
+        if self.first_day is None:
+            return None
+        start = (first_night - self.first_day).days
+        end = (last_night - self.first_day).days + 1
+        if start < 0 or end > self.available.shape[1]:
+            return None
+        return start, end
+
+    def filter_mask(self, skip_use_type: Optional[str], skip_campsite_types: List[str]) -> np.ndarray:
+        mask = np.ones(self.count, dtype=bool)
+        if skip_use_type:
+            mask &= self.use_types != skip_use_type
+        if skip_campsite_types:
+            mask &= ~np.isin(self.campsite_types, skip_campsite_types)
+        return mask
+
+    def available_rows(self, first_night: datetime, last_night: datetime,
+                       skip_use_type: Optional[str] = None, skip_campsite_types: List[str] = ()) -> np.ndarray:
+        """ Returns indexes of the sites available every night of first_night..last_night (both included). """
+        if last_night < first_night:
+            return np.flatnonzero(self.filter_mask(skip_use_type, skip_campsite_types))
+        columns = self._columns(first_night, last_night)
+        if columns is None:
+            return np.zeros(0, dtype=int)
+        mask = self.available[:, columns[0]:columns[1]].all(axis=1)
+        return np.flatnonzero(mask & self.filter_mask(skip_use_type, skip_campsite_types))
+
+    def available_windows(self, first_night: datetime, last_night: datetime, nights: int,
+                          skip_use_type: Optional[str] = None,
+                          skip_campsite_types: List[str] = ()) -> List[Tuple[datetime, np.ndarray]]:
+        """
+        Finds stays of `nights` nights in a row within first_night..last_night with a single
+        prefix sum pass. Returns (first night of the stay, indexes of sites available for it) pairs.
+        """
+        columns = self._columns(first_night, last_night)
+        if nights <= 0 or columns is None or columns[1] - columns[0] < nights:
+            return []
+        window = self.available[:, columns[0]:columns[1]]
+        sums = np.zeros((window.shape[0], window.shape[1] + 1), dtype=np.int32)
+        np.cumsum(window, axis=1, out=sums[:, 1:])
+        fits = (sums[:, nights:] - sums[:, :-nights]) == nights
+        fits &= self.filter_mask(skip_use_type, skip_campsite_types)[:, None]
+        return [(first_night + timedelta(days=int(offset)), np.flatnonzero(fits[:, offset]))
+                for offset in np.flatnonzero(fits.any(axis=0))]
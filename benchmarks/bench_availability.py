@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Compares the set-based availability check get_available_sites_info used to do
+with AvailabilityMatrix on synthetic campgrounds.
+
+    python benchmarks/bench_availability.py --sites 500 --months 3 --requests 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import date_helper  # noqa: E402
+from availability_matrix import AvailabilityMatrix  # noqa: E402
+
+STATUSES = ["Available", "Reserved", "Not Reservable", "Open"]
+
+
+def synthetic_months(sites, months, density, seed=0):
+    rnd = random.Random(seed)
+    first = datetime(2030, 6, 1)
+    ret = []
+    for m in range(months):
+        start = (first + timedelta(days=31 * m)).replace(day=1)
+        days = []
+        day = start
+        while day.month == start.month:
+            days.append(date_helper.format_date(day))
+            day += timedelta(days=1)
+        campsites = {}
+        for i in range(sites):
+            campsites[str(i)] = {
+                "campsite_id": str(i),
+                "type_of_use": rnd.choice(["Overnight", "Overnight", "Day"]),
+                "campsite_type": rnd.choice(["STANDARD NONELECTRIC", "TENT ONLY NONELECTRIC", "MANAGEMENT"]),
+                "availabilities": {d: "Available" if rnd.random() < density else rnd.choice(STATUSES[1:])
+                                   for d in days},
+            }
+        ret.append({"campsites": campsites, "count": sites})
+    return ret
+
+
+def synthetic_requests(months, count, seed=0):
+    rnd = random.Random(seed)
+    ret = []
+    for _ in range(count):
+        start = datetime(2030, 6, 1) + timedelta(days=rnd.randrange(months * 28 - 6))
+        ret.append((start, start + timedelta(days=rnd.randint(1, 5))))
+    return ret
+
+
+def legacy_available_ids(merged, start_date, end_date, skip_use_type, skip_types):
+    """ The set-based check as get_available_sites_info did it before AvailabilityMatrix. """
+    ret = []
+    num_days = (end_date - start_date).days
+    dates = {end_date - timedelta(days=i) for i in range(num_days)}
+    for site in merged["campsites"].values():
+        if skip_use_type and site['type_of_use'] == skip_use_type:
+            continue
+        if site["campsite_type"].upper().replace(" ", "_") in skip_types:
+            continue
+        available_dates = {date_helper.date_from_str(
+            date) for date, status in site["availabilities"].items() if status == "Available"}
+        if dates.issubset(available_dates):
+            ret.append(site["campsite_id"])
+    return ret
+
+
+def merge(months):
+    merged = {"campsites": {}}
+    for info in months:
+        for campsite_id, site in info["campsites"].items():
+            if campsite_id not in merged["campsites"]:
+                merged["campsites"][campsite_id] = dict(site, availabilities=dict(site["availabilities"]))
+            else:
+                merged["campsites"][campsite_id]["availabilities"].update(site["availabilities"])
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=500)
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--density", type=float, default=0.3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    months = synthetic_months(args.sites, args.months, args.density)
+    requests = synthetic_requests(args.months, args.requests)
+    merged = merge(months)
+    skip_use_type, skip_types = "Day", ["MANAGEMENT"]
+
+    def legacy():
+        return [legacy_available_ids(merged, s, e, skip_use_type, skip_types) for s, e in requests]
+
+    def vectorized():
+        matrix = AvailabilityMatrix.from_months(months)
+        return [[matrix.sites[row]["campsite_id"] for row in matrix.available_rows(
+            s + timedelta(days=1), e, skip_use_type, skip_types)] for s, e in requests]
+
+    assert legacy() == vectorized(), "AvailabilityMatrix disagrees with the set-based check"
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=args.repeat))
+    vectorized_time = min(timeit.repeat(vectorized, number=1, repeat=args.repeat))
+    print(f"{args.sites} sites x {args.months} months, {args.requests} date ranges")
+    print(f"set-based:  {legacy_time * 1000:8.1f} ms")
+    print(f"vectorized: {vectorized_time * 1000:8.1f} ms (matrix build included), {legacy_time / vectorized_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Runs Crawler.crawl and crawl_loop end to end against benchmarks/mock_server.py and reports
+requests per cycle, wall time, CPU time and peak memory of the checker.
+
+    python benchmarks/bench_crawl.py                      # all the scenarios
+    python benchmarks/bench_crawl.py crawl loop_changes   # some of them
+    python benchmarks/bench_crawl.py --compare            # results saved by previous runs
+
+The mock server and every scenario run in their own processes, so the numbers are the
+checker's only and scenarios do not share Connection caches. Results are appended to
+benchmarks/results.jsonl with the commit they were measured at.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_server import MockRecreationGov  # noqa: E402
+
+DEFAULT_RESULTS = os.path.join(ROOT, "benchmarks", "results.jsonl")
+
+# server: MockRecreationGov arguments, crawler: Crawler keyword arguments,
+# cycles: crawl_loop cycles to run, 0 calls crawl once
+SCENARIOS = {
+    "crawl": {
+        "camps": 10, "months": 2, "requests": 10, "cycles": 0,
+        "server": {"sites": 200, "density": 0.1, "latency": 0.02},
+        "crawler": {},
+    },
+    "crawl_big": {
+        "camps": 30, "months": 3, "requests": 40, "cycles": 0,
+        "server": {"sites": 500, "density": 0.2, "latency": 0.02},
+        "crawler": {},
+    },
+    "crawl_errors": {
+        "camps": 10, "months": 2, "requests": 10, "cycles": 0,
+        "server": {"sites": 200, "density": 0.1, "latency": 0.02, "error_rate": 0.05, "throttle_rate": 0.02},
+        "crawler": {"tolerate_failures": True, "retries": 2},
+    },
+    "loop": {
+        "camps": 10, "months": 2, "requests": 10, "cycles": 5, "check_freq": 1,
+        "server": {"sites": 200, "density": 0.1, "latency": 0.02},
+        "crawler": {},
+    },
+    "loop_max_age": {
+        "camps": 10, "months": 2, "requests": 10, "cycles": 5, "check_freq": 1,
+        "server": {"sites": 200, "density": 0.1, "latency": 0.02, "max_age": 3},
+        "crawler": {},
+    },
+    "loop_adaptive": {
+        "camps": 10, "months": 6, "requests": 10, "cycles": 10, "check_freq": 1,
+        "server": {"sites": 200, "density": 0.1, "latency": 0.02},
+        "crawler": {"adaptive_polling": True, "max_poll_interval": 8, "response_cache_size": 0},
+    },
+    "loop_changes": {
+        "camps": 10, "months": 2, "requests": 10, "cycles": 5, "check_freq": 1,
+        "server": {"sites": 200, "density": 0.1, "latency": 0.02, "change_every": 1},
+        "crawler": {"only_changes": True},
+    },
+}
+
+
+def make_request_str(camps: int, months: int, requests: int, seed: int = 0) -> str:
+    """ Returns a --request value of `requests` date ranges over the next `months` months. """
+    rnd = random.Random(seed)
+    first = datetime.date.today().replace(day=1) + datetime.timedelta(days=62)
+    first = first.replace(day=1)
+    camp_ids = list(range(1000, 1000 + camps))
+    ret = []
+    for i in range(requests):
+        start = first + datetime.timedelta(days=rnd.randrange(months * 28 - 5))
+        end = start + datetime.timedelta(days=rnd.randint(1, 4))
+        ids = rnd.sample(camp_ids, min(len(camp_ids), rnd.randint(1, 4)))
+        # Every camp is checked at least once
+        ids.append(camp_ids[i % len(camp_ids)])
+        ret.append(f"{start}..{end}:{','.join(str(x) for x in sorted(set(ids)))}")
+    return ";".join(ret)
+
+
+def _serve(server_args: dict, port_queue: multiprocessing.Queue) -> None:
+    server = MockRecreationGov(**server_args)
+
+    async def serve():
+        port_queue.put(await server.start())
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(serve())
+
+
+def _run_scenario(scenario: dict, port: int, result_queue: multiprocessing.Queue) -> None:
+    import metrics
+    from connection import Connection
+    from crawl import Crawler
+    from user_request import UseType, CampsiteType
+
+    logging.basicConfig(level=logging.ERROR)
+    Connection.BASE_URL = f"http://127.0.0.1:{port}"
+    kwargs = {"max_rps": 0, "notify_file": os.devnull}
+    kwargs.update(scenario["crawler"])
+    request_str = make_request_str(scenario["camps"], scenario["months"], scenario["requests"])
+
+    async def run():
+        crawler = Crawler(request_str, False, False, False, "", "", UseType.Day,
+                          [CampsiteType.MANAGEMENT], **kwargs)
+        async with crawler:
+            if not scenario["cycles"]:
+                await crawler.crawl()
+                return
+            task = asyncio.ensure_future(crawler.crawl_loop(scenario["check_freq"], 0, 24))
+            while metrics.CYCLE_SECONDS.count() < scenario["cycles"] and not task.done():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    asyncio.run(run())
+    result_queue.put({
+        "wall_seconds": time.perf_counter() - wall,
+        "cpu_seconds": time.process_time() - cpu,
+        # Kilobytes on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cycles": max(1, int(metrics.CYCLE_SECONDS.count())),
+        "connections": {"new": metrics.CONNECTIONS.value(result="new"),
+                        "reused": metrics.CONNECTIONS.value(result="reused")},
+        "transferred_mib": metrics.RESPONSE_WIRE_BYTES.total() / 1024 / 1024,
+        "saved_mib": metrics.RESPONSE_BYTES_SAVED.total() / 1024 / 1024,
+    })
+
+
+def _post(port: int, path: str) -> dict:
+    async def request():
+        import aiohttp
+        async with aiohttp.ClientSession() as session:
+            method = session.post if path == "/_reset" else session.get
+            async with method(f"http://127.0.0.1:{port}{path}") as resp:
+                return await resp.json()
+    return asyncio.run(request())
+
+
+def run_scenario(name: str, scenario: dict) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    port_queue, result_queue = ctx.Queue(), ctx.Queue()
+    server = ctx.Process(target=_serve, args=(scenario["server"], port_queue), daemon=True)
+    server.start()
+    try:
+        port = port_queue.get(timeout=30)
+        checker = ctx.Process(target=_run_scenario, args=(scenario, port, result_queue))
+        checker.start()
+        checker.join()
+        if checker.exitcode:
+            raise RuntimeError(f"Scenario {name} failed with exit code {checker.exitcode}")
+        result = result_queue.get(timeout=30)
+        stats = _post(port, "/_stats")
+    finally:
+        server.terminate()
+        server.join()
+    result["requests"] = stats["requests"]
+    result["statuses"] = stats["statuses"]
+    result["requests_per_cycle"] = stats["total_requests"] / result["cycles"]
+    result["received_mib"] = stats["bytes_sent"] / 1024 / 1024
+    return result
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, text=True)
+        return commit + ("+" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def format_row(commit: str, name: str, r: dict) -> str:
+    return (f"{commit:>10} {name:>14} {r['requests_per_cycle']:>10.1f} {r['wall_seconds']:>8.2f} "
+            f"{r['cpu_seconds']:>8.2f} {r['peak_rss_mib']:>9.1f} {r['received_mib']:>9.1f} "
+            f"{r.get('transferred_mib', r['received_mib']):>9.1f} {r.get('connections', {}).get('new', '-'):>9}")
+
+
+HEADER = (f"{'commit':>10} {'scenario':>14} {'req/cycle':>10} {'wall s':>8} {'cpu s':>8} {'peak MiB':>9} "
+          f"{'recv MiB':>9} {'xfer MiB':>9} {'new conns':>9}")
+
+
+def compare(path: str, names) -> None:
+    """ Prints the latest result of every commit for the scenarios, in the order they were measured. """
+    latest = {}
+    with open(path) as fh:
+        for line in fh:
+            record = json.loads(line)
+            if not names or record["scenario"] in names:
+                latest[(record["commit"], record["scenario"])] = record
+    print(HEADER)
+    for (commit, name), record in sorted(latest.items(), key=lambda x: (x[0][1], x[1]["time"])):
+        print(format_row(commit, name, record["results"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run, default: all of {', '.join(SCENARIOS)}")
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help="Append results to this file, default: %(default)s")
+    parser.add_argument("--compare", action="store_true", help="Print saved results instead of running")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.compare:
+        compare(args.results, args.scenarios)
+        return
+
+    commit = git_commit()
+    print(HEADER)
+    for name in args.scenarios or SCENARIOS:
+        result = run_scenario(name, SCENARIOS[name])
+        print(format_row(commit, name, result), flush=True)
+        with open(args.results, "a") as fh:
+            print(json.dumps({"commit": commit, "time": datetime.datetime.now().isoformat(), "scenario": name,
+                              "scenario_config": SCENARIOS[name], "results": result}), file=fh)
+
+
+if __name__ == "__main__":
+    main()
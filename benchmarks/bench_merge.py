@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compares the deepcopy based month merge get_camp_information used to do with
+availability_matrix.merge_months, and json with orjson (if installed) decoding.
+
+    python benchmarks/bench_merge.py --sites 500 --months 3
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from availability_matrix import merge_months  # noqa: E402
+from bench_availability import synthetic_months  # noqa: E402
+
+
+def legacy_merge(infos):
+    """ The merge as get_camp_information did it before merge_months, with the eager debug dump. """
+    camp_information = {}
+    for info in infos:
+        if not camp_information:
+            camp_information = copy.deepcopy(info)
+            continue
+        for campsite_id, campsite_infos in info["campsites"].items():
+            if campsite_id not in camp_information["campsites"]:
+                camp_information["campsites"][campsite_id] = campsite_infos
+            else:
+                camp_information["campsites"][campsite_id]["availabilities"].update(
+                    campsite_infos["availabilities"])
+    camp_information["count"] = len(camp_information["campsites"])
+    "Information for {}: {}".format(0, json.dumps(camp_information, indent=1))
+    return camp_information
+
+
+def measure(fn, repeat):
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=500)
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    raw = [json.dumps(x).encode() for x in synthetic_months(args.sites, args.months, 0.3)]
+    camp_months = args.months
+    print(f"{args.sites} sites x {args.months} months, {sum(len(x) for x in raw) / 1024:.0f} KiB of JSON")
+
+    decoders = [("json", json.loads)]
+    try:
+        import orjson
+        decoders.append(("orjson", orjson.loads))
+    except ImportError:
+        print("orjson is not installed, skipping it")
+    for name, loads in decoders:
+        best, peak = measure(lambda: [loads(x) for x in raw], args.repeat)
+        print(f"decode {name:7}      {best * 1000 / camp_months:8.2f} ms/camp-month, peak {peak / 1024 / camp_months:8.0f} KiB/camp-month")
+
+    for name, merge in [("deepcopy merge", legacy_merge), ("merge_months", merge_months)]:
+        # the legacy merge modifies the responses, give every run fresh ones
+        infos_runs = [[json.loads(x) for x in raw] for _ in range(args.repeat + 1)]
+        best = min(timeit.repeat(lambda: merge(infos_runs.pop()), number=1, repeat=args.repeat))
+        infos = [json.loads(x) for x in raw]
+        tracemalloc.start()
+        merge(infos)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:20} {best * 1000 / camp_months:8.2f} ms/camp-month, peak {peak / 1024 / camp_months:8.0f} KiB/camp-month")
+
+
+if __name__ == "__main__":
+    main()
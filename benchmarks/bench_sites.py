@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Compares the CampsiteInfo objects render built every check before SiteRegistry, plain objects made of
+the site dicts of the month response, with the slotted ones SiteRegistry keeps across checks, on
+synthetic sites decoded from JSON like a response.
+
+    python benchmarks/bench_sites.py --sites 10000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_index import RateIndex  # noqa: E402
+from site_registry import SiteRegistry  # noqa: E402
+
+TYPES = ["STANDARD NONELECTRIC", "STANDARD ELECTRIC", "TENT ONLY NONELECTRIC", "RV NONELECTRIC"]
+START_DATE, END_DATE = datetime(2030, 7, 1), datetime(2030, 7, 3)
+
+
+class LegacyCampsiteInfo:
+    """ CampsiteInfo as user_request.py had it before SiteRegistry. """
+
+    def __init__(self, campsite_id, capacity_rating, min_num_people, max_num_people, loop, site, campsite_type,
+                 rate, rate_str):
+        self.campsite_id = campsite_id
+        self.capacity_rating = capacity_rating
+        self.min_num_people = min_num_people
+        self.max_num_people = max_num_people
+        self.loop = loop
+        self.site = site
+        self.campsite_type = campsite_type
+        self.rate = rate
+        self.rate_str = rate_str
+
+    @classmethod
+    def from_site(cls, site: dict, rate_index: RateIndex, start_date: datetime, end_date: datetime):
+        rate, rate_str = rate_index.lookup(site["campsite_type"], start_date, end_date)
+        return cls(site["campsite_id"], site["capacity_rating"], site["min_num_people"], site["max_num_people"],
+                   site["loop"], site["site"], site["campsite_type"], rate, rate_str)
+
+
+def synthetic_payload(sites: int) -> bytes:
+    return json.dumps({str(1000 + i): {
+        "campsite_id": str(1000 + i), "capacity_rating": ["Single", "Double", "Group"][i % 3],
+        "min_num_people": 1, "max_num_people": [6, 8, 12][i % 3], "loop": f"Loop {chr(ord('A') + i % 5)}",
+        "site": f"{i % 200:03d}", "campsite_type": TYPES[i % 4], "type_of_use": "Overnight",
+    } for i in range(sites)}).encode()
+
+
+def synthetic_rates() -> RateIndex:
+    return RateIndex({"rates_list": [{
+        "season_start": "2020-01-01T00:00:00Z", "season_end": "2040-01-01T00:00:00Z",
+        "site_type_map": {str(k): t for k, t in enumerate(TYPES)},
+        "rate_map": {str(k): {"per_night": 20 + k, "per_person": 0, "group_fees": None} for k in range(len(TYPES))},
+    }]})
+
+
+def traced(fn) -> int:
+    """ Returns the bytes allocated by fn still in use while its result is kept. """
+    gc.collect()
+    tracemalloc.start()
+    kept = fn()  # noqa: F841
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    raw = synthetic_payload(args.sites)
+    rate_index = synthetic_rates()
+    print(f"{args.sites} sites, {len(raw) / 1024:.0f} KiB of JSON")
+
+    # A check decodes the month response and gets the CampsiteInfo of its sites, the response is dropped after it
+    def legacy_check():
+        return [LegacyCampsiteInfo.from_site(x, rate_index, START_DATE, END_DATE) for x in json.loads(raw).values()]
+
+    registry = SiteRegistry()
+
+    def registry_check():
+        return registry.infos(1, list(json.loads(raw).values()), rate_index, START_DATE, END_DATE)
+
+    results = {}
+    for name, check in [("dict-based", legacy_check), ("SiteRegistry", registry_check)]:
+        first = traced(check)
+        again = traced(check)
+        best = min(timeit.repeat(check, number=1, repeat=args.repeat))
+        results[name] = again
+        print(f"{name:12} first check {first / 1024:6.0f} KiB, next ones {again / 1024:6.0f} KiB in use "
+              f"after the check, {best * 1000:6.2f} ms/check")
+    print(f"saved per check of {args.sites} sites: {(results['dict-based'] - results['SiteRegistry']) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Checks that a replay runs on the recorded clock even when the stays of the archive are over by now,
+against benchmarks/mock_server.py, no network needed:
+- an archive recorded two months ago for stays starting a month ago is replayed: the requests are
+  evaluated, all of it is replayed and the sites are reported
+- PollScheduler caps a month by how far it is from the recorded time, not from now
+
+    python benchmarks/check_replay.py
+
+Exits with 1 if any of the checks fails.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_server import MockRecreationGov  # noqa: E402
+from connection import Connection  # noqa: E402
+from crawl import Crawler  # noqa: E402
+from poll_scheduler import PollScheduler  # noqa: E402
+from response_archive import ResponseArchive  # noqa: E402
+from user_request import UserRequest  # noqa: E402
+
+CYCLES = 3
+# The archive is moved this far back, the stays start STAY_DAYS_AGO days ago
+RECORDED_DAYS_AGO = 60
+STAY_DAYS_AGO = 30
+
+
+async def record_past(path: str, request_str: str) -> None:
+    """ Records CYCLES checks of the request and moves them RECORDED_DAYS_AGO back. """
+    server = MockRecreationGov(sites=20, density=0.3)
+    Connection.BASE_URL = f"http://127.0.0.1:{await server.start()}"
+    archive = ResponseArchive(path)
+    Connection.configure_archive(archive)
+    Connection.open_session()
+    try:
+        user_requests = UserRequest.make_user_requests(request_str, False, False, False, None, None)
+        for _ in range(CYCLES):
+            # Crawler would not check stays in the past, the requests fetch their months themselves
+            for user_request in user_requests:
+                await user_request.process_request()
+            await asyncio.sleep(0.1)
+    finally:
+        await Connection.close_session()
+        Connection.configure_archive(None)
+        archive.close()
+        await server.stop()
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE responses SET received_at = received_at - ?",
+                   (datetime.timedelta(days=RECORDED_DAYS_AGO).total_seconds(),))
+
+
+async def replay(path: str, request_str: str):
+    """ Replays the archive, returns (notifications, responses left). """
+    for cache in (Connection.CAMP_NAMES, Connection.CAMP_RATES, Connection.CAMP_RATE_INDEXES):
+        cache.clear()
+    # Nothing is fetched when replaying
+    Connection.BASE_URL = "http://127.0.0.1:9"
+    messages = []
+    crawler = Crawler(request_str, False, False, False, "", "", None, None, max_rps=0, replay=path)
+    crawler.watch("default").notify = messages.append
+    async with crawler:
+        await asyncio.wait_for(crawler.crawl_loop(60, 0, 24), 30)
+        return messages, crawler._archive.remaining()
+
+
+def check_scheduler() -> bool:
+    """ A month a month after the recorded time is polled less often than a month in the past. """
+    recorded_at = datetime.datetime.now() - datetime.timedelta(days=RECORDED_DAYS_AGO)
+    key = (1, datetime.datetime.now() - datetime.timedelta(days=STAY_DAYS_AGO))
+    scheduler = PollScheduler(60, 3600)
+    at = recorded_at.timestamp()
+    for _ in range(2):
+        scheduler.due([key], at)
+        scheduler.record(key, "unchanged", at, recorded_at)
+        at += 60
+    # Grown to 90 seconds from the recorded time, it would stay at min_interval counted from now
+    return not scheduler.due([key], at + 10)
+
+
+async def main() -> int:
+    logging.basicConfig(level=logging.ERROR)
+    start = datetime.date.today() - datetime.timedelta(days=STAY_DAYS_AGO)
+    camps = ",".join(str(1000 + i) for i in range(4))
+    request_str = f"{start}..{start + datetime.timedelta(days=2)}:{camps}"
+    checks = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "archive.sqlite")
+        await record_past(path, request_str)
+        messages, remaining = await replay(path, request_str)
+    text = "".join(messages)
+    checks.append((f"past stays replayed: {len(messages)} message(s), {text.count('🏕')} camp(s) found, "
+                   f"{remaining} responses left", text.count("🏕") > 0 and remaining == 0))
+    checks.append(("polling capped on the recorded clock", check_scheduler()))
+
+    for name, ok in checks:
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Checks that a check sends the same lines however it runs, against benchmarks/mock_server.py,
+no network needed:
+- default: UserRequest.process_request of every request, the report sent when anything is available
+- streaming: Crawler.crawl in this process, camps sent as they are evaluated
+- shards: Crawler.crawl with --workers
+
+with and without --only_available. The lines are compared regardless of their order and of
+how they are split into messages.
+
+    python benchmarks/check_stream.py
+
+Exits with 1 if any of the checks fails.
+"""
+
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_server import MockRecreationGov  # noqa: E402
+from connection import Connection  # noqa: E402
+from crawl import Crawler  # noqa: E402
+from user_request import UserRequest  # noqa: E402
+
+
+def make_request_str() -> str:
+    """ A request finding sites in some camps only and one finding nothing. """
+    start = datetime.date.today() + datetime.timedelta(days=40)
+    camps = ",".join(str(1000 + i) for i in range(8))
+    return f"{start}..{start + datetime.timedelta(days=1)}:{camps};" \
+           f"{start}..{start + datetime.timedelta(days=20)}~6n:{camps}"
+
+
+def sent_lines(messages) -> collections.Counter:
+    return collections.Counter(line for message in messages for line in message.splitlines() if line.strip())
+
+
+async def default_lines(request_str: str, only_available: bool) -> collections.Counter:
+    Connection.open_session()
+    try:
+        reports = [await x.process_request() for x in UserRequest.make_user_requests(
+            request_str, only_available, False, False, None, None)]
+    finally:
+        await Connection.close_session()
+    if not any(avail for avail, _ in reports):
+        return collections.Counter()
+    return sent_lines(out for _, out in reports)
+
+
+async def crawl_lines(request_str: str, only_available: bool, workers: int) -> collections.Counter:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "notifications.txt")
+        crawler = Crawler(request_str, only_available, False, False, "", "", None, None, max_rps=0,
+                          notify_file=path, notify_batch_window=0, workers=workers)
+        async with crawler:
+            await crawler.crawl(0)
+        if not os.path.exists(path):
+            return collections.Counter()
+        with open(path) as fh:
+            return sent_lines([fh.read()])
+
+
+def reset_caches() -> None:
+    for cache in (Connection.CAMP_NAMES, Connection.CAMP_RATES, Connection.CAMP_RATE_INDEXES):
+        cache.clear()
+
+
+async def main() -> int:
+    logging.basicConfig(level=logging.ERROR)
+    server = MockRecreationGov(sites=12, density=0.08)
+    Connection.BASE_URL = f"http://127.0.0.1:{await server.start()}"
+    request_str = make_request_str()
+    checks = []
+    try:
+        for only_available in (False, True):
+            outputs = {}
+            for name, make in (("default", lambda: default_lines(request_str, only_available)),
+                               ("streaming", lambda: crawl_lines(request_str, only_available, 0)),
+                               ("shards", lambda: crawl_lines(request_str, only_available, 2))):
+                reset_caches()
+                outputs[name] = await make()
+            for name in ("streaming", "shards"):
+                missing = outputs["default"] - outputs[name]
+                extra = outputs[name] - outputs["default"]
+                checks.append((f"only_available={only_available} {name}: {sum(outputs[name].values())} lines, "
+                               f"{sum(missing.values())} missing, {sum(extra.values())} extra",
+                               bool(outputs["default"]) and not missing and not extra))
+    finally:
+        await server.stop()
+
+    for name, ok in checks:
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
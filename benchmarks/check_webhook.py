@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Checks WebhookSink and NotificationQueue against a local HTTP stand-in of a webhook receiver,
+no network needed:
+- messages arrive as {"text": message} JSON POSTs
+- messages put within the batch window arrive joined into one POST
+- a receiver answering 500 gets the message again, and only once it is taken
+- a slow receiver does not make NotificationQueue.put wait
+
+    python benchmarks/check_webhook.py
+
+Exits with 1 if any of the checks fails.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from notifications import NotificationQueue, WebhookSink  # noqa: E402
+
+
+class WebhookStandIn:
+    """ Takes webhook POSTs on 127.0.0.1, fails the first `failures` of them with 500. """
+
+    def __init__(self, failures: int = 0, latency: float = 0):
+        self.failures = failures
+        self.latency = latency
+        self.posts = 0
+        self.received = []
+        self._runner = None
+
+    async def _post(self, request: web.Request) -> web.Response:
+        self.posts += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.posts <= self.failures:
+            return web.json_response({"error": "stand-in failure"}, status=500)
+        self.received.append(await request.json())
+        return web.json_response({"ok": True})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/hook", self._post)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/hook"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+async def deliver(stand_in: WebhookStandIn, messages, batch_window: float = 0.2, retries: int = 3) -> float:
+    """ Sends the messages through a NotificationQueue with a WebhookSink, returns the longest put. """
+    sink = WebhookSink(await stand_in.start())
+    sink.retries = retries
+    queue = NotificationQueue([sink], batch_window)
+    queue.start()
+    longest = 0.0
+    try:
+        for message in messages:
+            started_at = time.monotonic()
+            queue.put(message)
+            longest = max(longest, time.monotonic() - started_at)
+        await queue.close()
+    finally:
+        await stand_in.stop()
+    return longest
+
+
+async def main() -> int:
+    checks = []
+
+    stand_in = WebhookStandIn()
+    await deliver(stand_in, ["first", "second"])
+    checks.append(("batched into one JSON POST", stand_in.received == [{"text": "first\nsecond"}]))
+
+    stand_in = WebhookStandIn(failures=2)
+    await deliver(stand_in, ["retried"], retries=3)
+    checks.append(("500 retried, delivered once", stand_in.posts == 3 and stand_in.received == [{"text": "retried"}]))
+
+    stand_in = WebhookStandIn(failures=10)
+    await deliver(stand_in, ["lost"], retries=1)
+    checks.append(("given up after the retries", stand_in.posts == 2 and stand_in.received == []))
+
+    stand_in = WebhookStandIn(latency=0.5)
+    longest = await deliver(stand_in, [f"message {i}" for i in range(20)], batch_window=0)
+    checks.append((f"put never waits on delivery (longest {longest * 1000:.2f} ms)",
+                   longest < 0.05 and len(stand_in.received) >= 1))
+
+    for name, ok in checks:
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    return 0 if all(ok for _, ok in checks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
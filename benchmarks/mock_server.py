@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Local imitation of the recreation.gov endpoints the checker uses, serving synthetic campgrounds:
+
+    GET /api/camps/availability/campground/<id>/month?start_date=...
+    GET /api/camps/campgrounds/<id>
+    GET /api/camps/campgrounds/<id>/rates
+
+plus GET /_stats with request counts and POST /_reset to zero them.
+Point Connection.BASE_URL at it:
+
+    python benchmarks/mock_server.py --port 8080 --sites 300 --latency 0.05 --error_rate 0.02
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+from aiohttp import web
+
+RESPONSE_DATE_FORMAT = "%Y-%m-%dT00:00:00Z"
+REQUEST_DATE_FORMAT = "%Y-%m-%dT00:00:00.000Z"
+NOT_AVAILABLE = ["Reserved", "Reserved", "Not Reservable", "Open"]
+CAMPSITE_TYPES = ["STANDARD NONELECTRIC", "STANDARD ELECTRIC", "TENT ONLY NONELECTRIC", "RV ELECTRIC", "MANAGEMENT"]
+
+
+class MockRecreationGov:
+    """
+    Every campground has `sites` sites, each day of a site is available with `density` probability.
+    Payloads are stable for a camp and month, unless change_every is set: then they are rerolled
+    every change_every seconds. Responses are delayed by latency * U(0.5, 1.5) seconds and fail with
+    500 or 429 with error_rate and throttle_rate probabilities.
+    Responses carry an ETag and If-None-Match is answered with 304, Cache-Control max-age is sent
+    when max_age is set. bytes_sent counts bodies before compression.
+    """
+
+    def __init__(self, sites: int = 100, density: float = 0.1, latency: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, change_every: float = 0, seed: int = 0, compress: bool = True,
+                 max_age: int = 0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.sites = sites
+        self.density = density
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.change_every = change_every
+        self.seed = seed
+        self.compress = compress
+        self.max_age = max_age
+        self._random = random.Random(seed)
+        self._payloads: Dict[Tuple, bytes] = {}
+        self._etags: Dict[bytes, str] = {}
+        self._runner = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests: Dict[str, int] = {}
+        self.statuses: Dict[str, int] = {}
+        self.bytes_sent = 0
+
+    def stats(self) -> dict:
+        return {
+            "requests": dict(self.requests),
+            "total_requests": sum(self.requests.values()),
+            "statuses": dict(self.statuses),
+            "bytes_sent": self.bytes_sent,
+        }
+
+    def _epoch(self) -> int:
+        return int(time.time() // self.change_every) if self.change_every else 0
+
+    def month(self, camp_id: int, start: datetime) -> bytes:
+        key = ("month", camp_id, start, self._epoch())
+        if key not in self._payloads:
+            rnd = random.Random(f"{self.seed}-{camp_id}-{start:%Y-%m}-{key[-1]}")
+            days = []
+            day = start
+            while day.month == start.month:
+                days.append(day.strftime(RESPONSE_DATE_FORMAT))
+                day += timedelta(days=1)
+            campsites = {}
+            for i in range(self.sites):
+                site_rnd = random.Random(f"{self.seed}-{camp_id}-{i}")
+                campsite_id = str(camp_id * 100000 + i)
+                campsites[campsite_id] = {
+                    "campsite_id": campsite_id,
+                    "site": f"{i:03d}",
+                    "loop": f"Loop {chr(ord('A') + i % 5)}",
+                    "type_of_use": site_rnd.choice(["Overnight", "Overnight", "Overnight", "Day"]),
+                    "campsite_type": site_rnd.choice(CAMPSITE_TYPES),
+                    "capacity_rating": site_rnd.choice(["Single", "Double", "Group"]),
+                    "min_num_people": 1,
+                    "max_num_people": site_rnd.choice([6, 8, 12]),
+                    "availabilities": {d: "Available" if rnd.random() < self.density else rnd.choice(NOT_AVAILABLE)
+                                       for d in days},
+                }
+            self._payloads[key] = json.dumps({"campsites": campsites, "count": self.sites}).encode()
+        return self._payloads[key]
+
+    def campground(self, camp_id: int) -> bytes:
+        return json.dumps({"campground": {"facility_name": f"MOCK CAMPGROUND {camp_id}"}}).encode()
+
+    def rates(self, camp_id: int) -> bytes:
+        first = datetime(datetime.now().year - 1, 1, 1)
+        rates_list = []
+        for year in range(4):
+            site_type_map = {str(i): t for i, t in enumerate(CAMPSITE_TYPES)}
+            rate_map = {str(i): {"per_night": 20 + 5 * i + year, "per_person": 0, "group_fees": None}
+                        for i in range(len(CAMPSITE_TYPES))}
+            rates_list.append({
+                "season_start": first.replace(year=first.year + year).strftime(RESPONSE_DATE_FORMAT),
+                "season_end": first.replace(year=first.year + year + 1).strftime(RESPONSE_DATE_FORMAT),
+                "site_type_map": site_type_map,
+                "rate_map": rate_map,
+            })
+        return json.dumps({"rates_list": rates_list}).encode()
+
+    def _etag(self, body: bytes) -> str:
+        if body not in self._etags:
+            self._etags[body] = f'"{hashlib.sha1(body).hexdigest()}"'
+        return self._etags[body]
+
+    async def _respond(self, request: web.Request, endpoint: str, make_body) -> web.Response:
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        roll = self._random.random()
+        if roll < self.error_rate:
+            status, body = 500, b'{"error": "mock failure"}'
+        elif roll < self.error_rate + self.throttle_rate:
+            status, body = 429, b'{"error": "too many requests"}'
+        else:
+            status, body = 200, make_body()
+        headers = {}
+        if status == 200:
+            headers["ETag"] = self._etag(body)
+            if self.max_age:
+                headers["Cache-Control"] = f"max-age={self.max_age}"
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                self.statuses["304"] = self.statuses.get("304", 0) + 1
+                return web.Response(status=304, headers=headers)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        self.bytes_sent += len(body)
+        response = web.Response(body=body, status=status, headers=headers, content_type="application/json")
+        if self.compress:
+            # Like recreation.gov, gzip when the client accepts it
+            response.enable_compression()
+        return response
+
+    async def _month(self, request: web.Request) -> web.Response:
+        camp_id = int(request.match_info["camp_id"])
+        start = datetime.strptime(request.query["start_date"], REQUEST_DATE_FORMAT)
+        return await self._respond(request, "availability", lambda: self.month(camp_id, start))
+
+    async def _campground(self, request: web.Request) -> web.Response:
+        camp_id = int(request.match_info["camp_id"])
+        return await self._respond(request, "campground", lambda: self.campground(camp_id))
+
+    async def _rates(self, request: web.Request) -> web.Response:
+        camp_id = int(request.match_info["camp_id"])
+        return await self._respond(request, "rates", lambda: self.rates(camp_id))
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def _reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/camps/availability/campground/{camp_id}/month", self._month)
+        app.router.add_get("/api/camps/campgrounds/{camp_id}", self._campground)
+        app.router.add_get("/api/camps/campgrounds/{camp_id}/rates", self._rates)
+        app.router.add_get("/_stats", self._stats)
+        app.router.add_post("/_reset", self._reset)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """ Starts serving, returns the port. """
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self._logger.info(f"Serving mock recreation.gov at http://{host}:{port}")
+        return port
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--sites", type=int, default=100, help="Sites per campground, default: %(default)s")
+    parser.add_argument("--density", type=float, default=0.1,
+                        help="Probability of a site day to be available, default: %(default)s")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean response delay in secs, default: %(default)s")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Share of 500 responses, default: %(default)s")
+    parser.add_argument("--throttle_rate", type=float, default=0.0, help="Share of 429 responses, default: %(default)s")
+    parser.add_argument("--change_every", type=float, default=0,
+                        help="Reroll availabilities every this amount of secs, 0 never does, default: %(default)s")
+    parser.add_argument("--no_compression", action="store_true", help="Never gzip responses")
+    parser.add_argument("--max_age", type=int, default=0,
+                        help="Send Cache-Control: max-age with this amount of secs, default: %(default)s")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = MockRecreationGov(args.sites, args.density, args.latency, args.error_rate,
+                               args.throttle_rate, args.change_every, args.seed, not args.no_compression, args.max_age)
+
+    async def serve():
+        await server.start(args.host, args.port)
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,35 @@
 #!/usr/bin/env python3
 
+import sys
+
+from startup_profile import ImportProfiler
+
+# Installed before the rest of the imports, so that their cost is seen
+PROFILER = ImportProfiler()
+if "--startup-profile" in sys.argv:
+    PROFILER.install()
+
 import asyncio
 import argparse
 import json
 import logging
-import sys
+import os
 from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 
 import date_helper
 
+import connection
 import crawl
+import history_store
 import user_request
 
 
+async def run(crawler, method, *args):
+    async with crawler:
+        return await method(*args)
+
+
 def setup_logging(level, log_file):
     if log_file:
         handler = RotatingFileHandler(
@@ -37,6 +53,7 @@ if __name__ == "__main__":
     parser_crawl = subparsers.add_parser("crawl")
     parser_crawl_loop = subparsers.add_parser("crawl_loop")
     parser_crawl_info = subparsers.add_parser("crawl_info")
+    parser_history = subparsers.add_parser("history")
 
     for sub_parser in [parser_crawl, parser_crawl_loop, parser_crawl_info]:
         sub_parser.add_argument(
@@ -63,7 +80,14 @@ if __name__ == "__main__":
         sub_parser.add_argument(
             "--request",
             help="Struct of requests as: start_date1..end_date1:id1,id2;start_date2..end_date2:id3,id4 \n" +
-            "Dates should be in format YYYY-MM-DD. End date - you expect to leave this day, not stay the night"
+            "Dates should be in format YYYY-MM-DD. End date - you expect to leave this day, not stay the night. \n" +
+            "Add ~Nn to dates to look for any N nights in a row between the dates: start_date..end_date~2n:id1,id2, " +
+            "stays are checked and priced like requests of their own dates"
+        )
+        sub_parser.add_argument(
+            "--watch_file",
+            help="JSON or YAML file with watches, each with its own request, filters and notification target. " +
+            "crawl_loop reloads it when it changes",
         )
         sub_parser.add_argument(
             "--html",
@@ -75,6 +99,63 @@ if __name__ == "__main__":
             "--log",
             help="Log file",
         )
+        sub_parser.add_argument(
+            "--startup-profile",
+            action="store_true",
+            help="Print import time per module to stderr before running the command",
+        )
+        sub_parser.add_argument(
+            "--connection_limit",
+            type=int,
+            default=connection.Connection.DEFAULT_CONNECTION_LIMIT,
+            help="Maximum number of open connections, 0 is no limit, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--connection_limit_per_host",
+            type=int,
+            default=connection.Connection.DEFAULT_CONNECTION_LIMIT_PER_HOST,
+            help="Maximum number of open connections to a host, 0 is no limit, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--dns_cache_ttl",
+            type=int,
+            default=connection.Connection.DEFAULT_DNS_CACHE_TTL,
+            help="Keep resolved addresses for this amount of secs, 0 disables the cache, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--keepalive_timeout",
+            type=float,
+            default=connection.Connection.DEFAULT_KEEPALIVE_TIMEOUT,
+            help="Keep idle connections open for this amount of secs, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--no_compression",
+            action="store_true",
+            help="Do not ask for compressed responses",
+        )
+        sub_parser.add_argument(
+            "--response_cache_size",
+            type=int,
+            default=connection.Connection.DEFAULT_RESPONSE_CACHE_SIZE,
+            help="Keep this many responses to revalidate them with conditional requests, 0 disables it, " +
+            "default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--metadata_cache",
+            help="SQLite file to keep camp names and rates in across restarts",
+        )
+        sub_parser.add_argument(
+            "--metadata_cache_ttl",
+            type=int,
+            default=7 * 24 * 60 * 60,
+            help="Refetch camp names and rates older than this amount of secs, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--metadata_cache_size",
+            type=int,
+            default=10000,
+            help="Keep at most this many entries in the metadata cache, default: %(default)s",
+        )
     for sub_parser in [parser_crawl, parser_crawl_loop]:
         sub_parser.add_argument(
             "--only_available",
@@ -114,11 +195,97 @@ if __name__ == "__main__":
             type=user_request.CampsiteType.validate_multi,
             help=f"Skip certain site types, default: '%(default)s'. Possible options: {user_request.CampsiteType.all_names()}"
         )
+        sub_parser.add_argument(
+            "--max_concurrency",
+            type=int,
+            default=connection.Connection.DEFAULT_MAX_CONCURRENCY,
+            help="Maximum number of requests in flight, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--max_rps",
+            type=float,
+            default=connection.Connection.DEFAULT_MAX_RPS,
+            help="Maximum requests per second to recreation.gov, 0 disables the limit, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--request_timeout",
+            type=float,
+            default=connection.Connection.DEFAULT_REQUEST_TIMEOUT,
+            help="Timeout of a single request in secs, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--retries",
+            type=int,
+            default=connection.Connection.DEFAULT_RETRIES,
+            help="Retry failed requests this many times with jittered exponential backoff, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--tolerate_failures",
+            action="store_true",
+            help="Report camps that could not be fetched as stale instead of failing the whole check",
+        )
+        sub_parser.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help="Fetch and evaluate camps in this many worker processes, camps are spread over them by " +
+                 "consistent hashing, 0 does everything in one process, default: %(default)s",
+        )
+        sub_parser.add_argument(
+            "--record",
+            help="Append every response from recreation.gov to this archive file to replay it later",
+        )
+        sub_parser.add_argument(
+            "--replay",
+            help="Answer requests with the responses recorded in this archive file instead of recreation.gov, " +
+            "crawl_loop runs the checks back to back on the recorded clock until the archive is replayed",
+        )
+        sub_parser.add_argument(
+            "--history_dir",
+            help="Append every site night that opened or was taken between checks to the history in this " +
+            "directory, query it with the history command",
+        )
+        sub_parser.add_argument(
+            "--pipeline_depth",
+            type=int,
+            default=32,
+            help="Fetch and evaluate at most this many camps at a time, default: %(default)s",
+        )
     parser_crawl_loop.add_argument(
         "--check_freq",
         type=int,
         default=1 * 60,
-        help="Sleep time in secs between checks, default: %(default)s",
+        help="Time in secs between starts of checks, default: %(default)s",
+    )
+    parser_crawl_loop.add_argument(
+        "--spread_requests",
+        type=float,
+        default=0.5,
+        help="Spread requests of a check over this fraction of check_freq instead of sending them at once, default: %(default)s",
+    )
+    parser_crawl_loop.add_argument(
+        "--adaptive_polling",
+        action="store_true",
+        help="Fetch camp months that change often or are soon every check and the others less often",
+    )
+    parser_crawl_loop.add_argument(
+        "--min_poll_interval",
+        type=int,
+        default=0,
+        help="With adaptive_polling, fetch a camp month at most every this amount of secs, default: check_freq",
+    )
+    parser_crawl_loop.add_argument(
+        "--max_poll_interval",
+        type=int,
+        default=30 * 60,
+        help="With adaptive_polling, fetch a camp month at least every this amount of secs, default: %(default)s",
+    )
+    parser_crawl_loop.add_argument(
+        "--poll_budget",
+        type=int,
+        default=0,
+        help="With adaptive_polling, fetch at most this many camp months per minute, 0 is no limit, " +
+        "default: %(default)s",
     )
     parser_crawl_loop.add_argument(
         "--dont_recheck_avail_for",
@@ -126,6 +293,12 @@ if __name__ == "__main__":
         default=15 * 60,
         help="Do not recheck available for this amount of secs, default: %(default)s",
     )
+    parser_crawl_loop.add_argument(
+        "--only_changes",
+        action="store_true",
+        help="Check every request every time and report only sites that opened or were taken since the previous check, " +
+        "dont_recheck_avail_for is ignored",
+    )
     parser_crawl_loop.add_argument(
         "--telegram_token",
         help="Send messages to telegram using this token"
@@ -134,6 +307,54 @@ if __name__ == "__main__":
         "--telegram_chat_id",
         help="Send messages to telegram chat with this id"
     )
+    parser_crawl_loop.add_argument(
+        "--webhook_url",
+        help="Send messages as JSON {\"text\": message} POSTs to this url"
+    )
+    parser_crawl_loop.add_argument(
+        "--notify_file",
+        help="Append messages to this file"
+    )
+    parser_crawl_loop.add_argument(
+        "--notify_batch_window",
+        type=float,
+        default=2,
+        help="Join messages coming within this amount of secs into one, default: %(default)s",
+    )
+    parser_crawl_loop.add_argument(
+        "--metrics_port",
+        type=int,
+        default=0,
+        help="Serve metrics in Prometheus format at http://127.0.0.1:<port>/metrics, disabled by default",
+    )
+    parser_crawl_loop.add_argument(
+        "--metrics_summary_every",
+        type=int,
+        default=10 * 60,
+        help="Log a metrics summary line every (default: %(default)s) secs",
+    )
+    parser_crawl_loop.add_argument(
+        "--control_port",
+        type=int,
+        default=0,
+        help="Serve the API to add, list and remove watches at http://127.0.0.1:<port>/watches, disabled by default",
+    )
+    parser_crawl_loop.add_argument(
+        "--control_socket",
+        help="Serve the API to add, list and remove watches at this unix socket",
+    )
+    parser_crawl_loop.add_argument(
+        "--control_token",
+        default=os.environ.get("CAMPING_CONTROL_TOKEN", ""),
+        help="Require this bearer token from the control API clients, needed with control_port, " +
+        "CAMPING_CONTROL_TOKEN environment variable by default",
+    )
+    parser_crawl_loop.add_argument(
+        "--watch_file_check_every",
+        type=float,
+        default=5,
+        help="Check watch_file for changes every this amount of secs, default: %(default)s",
+    )
     parser_crawl_loop.add_argument(
         "--send_info_every",
         type=int,
@@ -141,7 +362,31 @@ if __name__ == "__main__":
         help="Send info of active checks every (default: %(default)s) hours",
     )
 
+    parser_history.add_argument("--history_dir", required=True, help="Directory of the history")
+    parser_history.add_argument("--camp", type=int, help="Only events of this camp ID, all the camps by default")
+    parser_history.add_argument(
+        "--by",
+        choices=list(history_store.HistoryStore.BUCKETS),
+        default="hour",
+        help="Count events per hour of day, weekday (local time) or days before the night, default: %(default)s",
+    )
+    parser_history.add_argument(
+        "--event",
+        choices=["opened", "taken"],
+        default="opened",
+        help="Count site nights that opened (cancellations) or were taken, default: %(default)s",
+    )
+    parser_history.add_argument("--since", type=date_helper.valid_date, help="Only events since [YYYY-MM-DD]")
+
     args = parser.parse_args()
+    if args.cmd == "history":
+        try:
+            store = history_store.HistoryStore(args.history_dir, read_only=True)
+        except ValueError as e:
+            parser_history.error(str(e))
+        event = history_store.HistoryStore.OPENED if args.event == "opened" else history_store.HistoryStore.TAKEN
+        print(store.report(args.by, args.camp, event, args.since), end="")
+        sys.exit(0)
     logging_level = logging.INFO
     if args.quiet:
         logging_level = logging.WARNING
@@ -162,6 +407,11 @@ if __name__ == "__main__":
         if args.stdin:
             logger.warning("stdin option does not make sense for the request")
         request = args.request
+    elif args.watch_file and not (args.camps or args.stdin or args.start_date or args.end_date):
+        logger.info(f"No request given, watches are read from {args.watch_file}")
+    elif args.cmd == "crawl_loop" and (args.control_port or args.control_socket) and \
+            not (args.camps or args.stdin or args.start_date or args.end_date):
+        logger.info("No request given, watches are to be added with the control API")
     else:
         if args.stdin:
             camps = [p.strip() for p in sys.stdin]
@@ -175,22 +425,92 @@ if __name__ == "__main__":
     no_overall = False
     telegram_token = ""
     telegram_chat_id = ""
+    webhook_url = ""
+    notify_file = ""
+    notify_batch_window = 0
+    only_changes = False
+    metrics_port = 0
+    metrics_summary_every = 10 * 60
+    adaptive_polling = False
+    min_poll_interval = 0
+    max_poll_interval = 30 * 60
+    poll_budget = 0
+    control_port = 0
+    control_socket = ""
+    control_token = ""
+    watch_file_check_every = 5
     skip_use_type = None
     skip_campsite_types = None
+    max_concurrency = connection.Connection.DEFAULT_MAX_CONCURRENCY
+    max_rps = connection.Connection.DEFAULT_MAX_RPS
+    request_timeout = connection.Connection.DEFAULT_REQUEST_TIMEOUT
+    retries = connection.Connection.DEFAULT_RETRIES
+    tolerate_failures = False
+    workers = 0
+    pipeline_depth = 32
+    record = ""
+    replay = ""
+    history_dir = ""
     if args.cmd in ["crawl", "crawl_loop"]:
         only_available = args.only_available
         no_overall = args.no_overall
         skip_use_type = args.skip_use_type
         skip_campsite_types = args.skip_campsite_types
+        max_concurrency = args.max_concurrency
+        max_rps = args.max_rps
+        request_timeout = args.request_timeout
+        retries = args.retries
+        tolerate_failures = args.tolerate_failures
+        workers = args.workers
+        pipeline_depth = args.pipeline_depth
+        record = args.record or ""
+        replay = args.replay or ""
+        history_dir = args.history_dir or ""
     if args.cmd == "crawl_loop":
         telegram_token = args.telegram_token
         telegram_chat_id = args.telegram_chat_id
+        webhook_url = args.webhook_url
+        notify_file = args.notify_file
+        notify_batch_window = args.notify_batch_window
+        only_changes = args.only_changes
+        metrics_port = args.metrics_port
+        metrics_summary_every = args.metrics_summary_every
+        adaptive_polling = args.adaptive_polling
+        min_poll_interval = args.min_poll_interval
+        max_poll_interval = args.max_poll_interval
+        poll_budget = args.poll_budget
+        control_port = args.control_port
+        control_socket = args.control_socket
+        control_token = args.control_token
+        watch_file_check_every = args.watch_file_check_every
     crawler = crawl.Crawler(request, only_available, no_overall, args.html,
-                            telegram_token, telegram_chat_id, skip_use_type, skip_campsite_types)
+                            telegram_token, telegram_chat_id, skip_use_type, skip_campsite_types,
+                            max_concurrency=max_concurrency, max_rps=max_rps,
+                            request_timeout=request_timeout, retries=retries,
+                            tolerate_failures=tolerate_failures, webhook_url=webhook_url,
+                            notify_file=notify_file, notify_batch_window=notify_batch_window,
+                            metadata_cache=args.metadata_cache, metadata_cache_ttl=args.metadata_cache_ttl,
+                            metadata_cache_size=args.metadata_cache_size, only_changes=only_changes,
+                            metrics_port=metrics_port, metrics_summary_every=metrics_summary_every,
+                            connection_limit=args.connection_limit,
+                            connection_limit_per_host=args.connection_limit_per_host,
+                            dns_cache_ttl=args.dns_cache_ttl, keepalive_timeout=args.keepalive_timeout,
+                            compress=not args.no_compression, response_cache_size=args.response_cache_size,
+                            adaptive_polling=adaptive_polling, min_poll_interval=min_poll_interval,
+                            max_poll_interval=max_poll_interval, poll_budget=poll_budget,
+                            control_port=control_port, control_socket=control_socket,
+                            control_token=control_token, workers=workers,
+                            pipeline_depth=pipeline_depth, watch_file=args.watch_file or "",
+                            watch_file_check_every=watch_file_check_every, record=record, replay=replay,
+                            history_dir=history_dir)
+
+    if args.startup_profile:
+        PROFILER.uninstall()
+        print(PROFILER.report(), file=sys.stderr)
 
     if args.cmd == "crawl":
         try:
-            availabilities = asyncio.run(crawler.crawl())
+            availabilities = asyncio.run(run(crawler, crawler.crawl))
             if args.exit_code:
                 sys.exit(0 if availabilities else 61)
         except Exception as e:
@@ -199,8 +519,9 @@ if __name__ == "__main__":
     elif args.cmd == "crawl_loop":
         try:
             availabilities = asyncio.run(
-                crawler.crawl_loop(
-                    args.check_freq, args.dont_recheck_avail_for, args.send_info_every)
+                run(crawler, crawler.crawl_loop,
+                    args.check_freq, args.dont_recheck_avail_for, args.send_info_every,
+                    args.spread_requests)
             )
             if args.exit_code:
                 sys.exit(0 if availabilities else 61)
@@ -208,6 +529,6 @@ if __name__ == "__main__":
             logger.error(f"Something went wrong: {str(e)}")
             raise
     elif args.cmd == "crawl_info":
-        asyncio.run(crawler.crawl_info())
+        asyncio.run(run(crawler, crawler.crawl_info))
     else:
         raise ValueError("Unknown command")
@@ -0,0 +1,48 @@
+import logging
+import time
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing resource for `reset_after` seconds once it failed `failure_threshold` times in a row.
+    After the pause a single trial call is let through, its result closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_after: float = 5 * 60):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._failures = {}
+        self._opened_at = {}
+
+    def allow(self, key) -> bool:
+        opened_at = self._opened_at.get(key)
+        if opened_at is None:
+            return True
+        if time.monotonic() - opened_at >= self.reset_after:
+            # half-open: let one trial through, reopen on the next failure
+            self._opened_at[key] = time.monotonic()
+            self._failures[key] = self.failure_threshold - 1
+            return True
+        return False
+
+    def check(self, key) -> None:
+        if not self.allow(key):
+            raise CircuitOpenError(f"Circuit for {key} is open, skipping it")
+
+    def record_success(self, key) -> None:
+        self._failures.pop(key, None)
+        if self._opened_at.pop(key, None) is not None:
+            self._logger.info(f"Circuit for {key} is closed again")
+
+    def record_failure(self, key) -> None:
+        self._failures[key] = self._failures.get(key, 0) + 1
+        if self._failures[key] >= self.failure_threshold:
+            if key not in self._opened_at:
+                self._logger.warning(
+                    f"Circuit for {key} is open for {self.reset_after} seconds after {self._failures[key]} failures")
+            self._opened_at[key] = time.monotonic()
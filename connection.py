@@ -1,52 +1,311 @@
 import asyncio
 import aiohttp
-import copy
 from dateutil.relativedelta import relativedelta
 import json
 import logging
 import os
-from fake_useragent import UserAgent
+import random
+try:
+    # Several times faster on big availability responses, optional
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 import date_helper
+import metrics
+from availability_matrix import merge_months
+from circuit_breaker import CircuitBreaker
+from rate_index import RateIndex
+from rate_limiter import RequestScheduler
+from response_cache import ResponseCache
+
+
+class RetryableError(Exception):
+    pass
 
 
 class Connection:
     SESSION = None
-    HEADERS = {
-        "User-Agent": UserAgent().random,
-        'Accept-Encoding': 'identity, deflate, compress, gzip'
-    }
+    # A session picks one of these, bundled so that startup needs no network
+    USER_AGENTS = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/84.0.4147.105 Safari/537.36",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:79.0) Gecko/20100101 Firefox/79.0",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/84.0.4147.105 Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+        "Version/13.1.2 Safari/605.1.15",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:79.0) Gecko/20100101 Firefox/79.0",
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/84.0.4147.105 Safari/537.36",
+        "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:79.0) Gecko/20100101 Firefox/79.0",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/84.0.4147.125 Safari/537.36 Edg/84.0.522.59",
+    ]
     BASE_URL = "https://www.recreation.gov"
     AVAILABILITY_ENDPOINT = "api/camps/availability/campground/"
     MAIN_PAGE_ENDPOINT = "api/camps/campgrounds/"
     CAMP_NAMES = {}
     CAMP_RATES = {}
+    CAMP_RATE_INDEXES = {}
+    IN_FLIGHT = {}
+    DEFAULT_MAX_CONCURRENCY = 8
+    DEFAULT_MAX_RPS = 4.0
+    SCHEDULER = RequestScheduler(DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_RPS)
+    DEFAULT_REQUEST_TIMEOUT = 30
+    DEFAULT_RETRIES = 3
+    REQUEST_TIMEOUT = DEFAULT_REQUEST_TIMEOUT
+    RETRIES = DEFAULT_RETRIES
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 30
+    CAMP_BREAKER = CircuitBreaker()
+    METADATA_CACHE = None
+    DEFAULT_RESPONSE_CACHE_SIZE = 5000
+    RESPONSE_CACHE = ResponseCache(DEFAULT_RESPONSE_CACHE_SIZE)
+    DEFAULT_CONNECTION_LIMIT = 32
+    DEFAULT_CONNECTION_LIMIT_PER_HOST = 8
+    DEFAULT_DNS_CACHE_TTL = 300
+    DEFAULT_KEEPALIVE_TIMEOUT = 90
+    CONNECTION_LIMIT = DEFAULT_CONNECTION_LIMIT
+    CONNECTION_LIMIT_PER_HOST = DEFAULT_CONNECTION_LIMIT_PER_HOST
+    DNS_CACHE_TTL = DEFAULT_DNS_CACHE_TTL
+    KEEPALIVE_TIMEOUT = DEFAULT_KEEPALIVE_TIMEOUT
+    COMPRESS = True
+    ARCHIVE = None
 
     def __init__(self, start_date, end_date):
         self.start_date = start_date
         self.end_date = end_date
         self._logger = logging.getLogger(self.__class__.__name__)
 
+    @classmethod
+    def headers(cls) -> dict:
+        return {
+            "User-Agent": random.choice(cls.USER_AGENTS),
+            'Accept-Encoding': 'gzip, deflate' if cls.COMPRESS else 'identity'
+        }
+
+    @classmethod
+    def configure_session(cls, limit, limit_per_host, dns_cache_ttl, keepalive_timeout, compress):
+        """ Settings of the sessions opened after the call, 0 limits mean no limit. """
+        cls.CONNECTION_LIMIT = limit
+        cls.CONNECTION_LIMIT_PER_HOST = limit_per_host
+        cls.DNS_CACHE_TTL = dns_cache_ttl
+        cls.KEEPALIVE_TIMEOUT = keepalive_timeout
+        cls.COMPRESS = compress
+
+    @classmethod
+    def _trace_config(cls) -> aiohttp.TraceConfig:
+        """ Counts new and reused connections and DNS cache hits, to see how well the pool works. """
+        async def connection_created(session, context, params):
+            metrics.CONNECTIONS.inc(result="new")
+
+        async def connection_reused(session, context, params):
+            metrics.CONNECTIONS.inc(result="reused")
+
+        async def dns_cache_hit(session, context, params):
+            metrics.CACHE_REQUESTS.inc(cache="dns", result="hit")
+
+        async def dns_cache_miss(session, context, params):
+            metrics.CACHE_REQUESTS.inc(cache="dns", result="miss")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(connection_created)
+        trace_config.on_connection_reuseconn.append(connection_reused)
+        trace_config.on_dns_cache_hit.append(dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(dns_cache_miss)
+        return trace_config
+
+    @classmethod
+    def open_session(cls) -> aiohttp.ClientSession:
+        """ Opens the session shared by all the requests, must be called within the event loop. """
+        if cls.SESSION is None or cls.SESSION.closed:
+            connector = aiohttp.TCPConnector(
+                limit=cls.CONNECTION_LIMIT,
+                limit_per_host=cls.CONNECTION_LIMIT_PER_HOST,
+                ttl_dns_cache=cls.DNS_CACHE_TTL or None,
+                use_dns_cache=cls.DNS_CACHE_TTL > 0,
+                keepalive_timeout=cls.KEEPALIVE_TIMEOUT,
+            )
+            cls.SESSION = aiohttp.ClientSession(
+                connector=connector, headers=cls.headers(), trace_configs=[cls._trace_config()])
+        return cls.SESSION
+
+    @classmethod
+    async def close_session(cls) -> None:
+        if cls.SESSION is not None:
+            await cls.SESSION.close()
+            cls.SESSION = None
+
     @classmethod
     def get_session(cls):
-        if not cls.SESSION:
-            cls.SESSION = aiohttp.ClientSession(headers=cls.HEADERS)
-            if not cls.SESSION:
-                raise RuntimeError('Could not create session object')
+        if cls.SESSION is None or cls.SESSION.closed:
+            raise RuntimeError('Session is not opened, use Connection.open_session or Crawler as a context manager')
         return cls.SESSION
 
+    @classmethod
+    def configure_scheduler(cls, max_concurrency, max_rps):
+        cls.SCHEDULER = RequestScheduler(max_concurrency, max_rps)
+
+    @classmethod
+    def configure_metadata_cache(cls, metadata_cache):
+        """ Persists camp names and rates in metadata_cache (MetadataCache or None) across restarts. """
+        cls.METADATA_CACHE = metadata_cache
+
+    @classmethod
+    def configure_response_cache(cls, max_entries):
+        """ Keeps up to max_entries responses for conditional requests, 0 disables the cache. """
+        cls.RESPONSE_CACHE = ResponseCache(max_entries) if max_entries else None
+
+    @classmethod
+    def configure_archive(cls, archive):
+        """ Records responses to or replays them from archive (ResponseArchive or None). """
+        cls.ARCHIVE = archive
+
+    @classmethod
+    def _archive_url(cls, url):
+        """ Returns the url without BASE_URL, so archives replay against any of them. """
+        return url[len(cls.BASE_URL):] if url.startswith(cls.BASE_URL) else url
+
+    @classmethod
+    async def _replay(cls, url, params):
+        return cls.ARCHIVE.replay(cls._archive_url(url), params)
+
+    @classmethod
+    async def _get_metadata(cls, kind, camp_id, memory_cache, fetch):
+        """ Looks camp_id up in memory_cache, then in the persistent cache, then fetches and stores it. """
+        if camp_id in memory_cache:
+            metrics.CACHE_REQUESTS.inc(cache="metadata", result="hit")
+        else:
+            key = f"{kind}:{camp_id}"
+            value = cls.METADATA_CACHE.get(key) if cls.METADATA_CACHE is not None else None
+            metrics.CACHE_REQUESTS.inc(cache="metadata", result="miss" if value is None else "hit")
+            if value is not None:
+                memory_cache[camp_id] = value
+            else:
+                async def fetch_and_store():
+                    await fetch(camp_id)
+                    if cls.METADATA_CACHE is not None:
+                        cls.METADATA_CACHE.put(key, memory_cache[camp_id])
+                await cls.single_flight((kind, camp_id), fetch_and_store)
+        return memory_cache[camp_id]
+
+    @classmethod
+    def configure_retries(cls, request_timeout, retries):
+        cls.REQUEST_TIMEOUT = request_timeout
+        cls.RETRIES = retries
+
+    @classmethod
+    def _backoff(cls, attempt):
+        # "full jitter": spreads retries of requests that failed together
+        return random.uniform(0, min(cls.BACKOFF_MAX, cls.BACKOFF_BASE * 2 ** attempt))
+
+    @classmethod
+    async def single_flight(cls, key, coro_factory):
+        """ Awaits coro_factory() once for all the concurrent callers with the same key. """
+        task = cls.IN_FLIGHT.get(key)
+        metrics.CACHE_REQUESTS.inc(cache="in_flight", result="miss" if task is None else "hit")
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            cls.IN_FLIGHT[key] = task
+
+            def forget(done):
+                if cls.IN_FLIGHT.get(key) is done:
+                    del cls.IN_FLIGHT[key]
+            task.add_done_callback(forget)
+        # shield: a cancelled caller must not cancel the request others wait for
+        return await asyncio.shield(task)
+
     @classmethod
     async def send_request(cls, url, params):
-        async with cls.get_session().get(url, params=params) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                raise RuntimeError(
-                    "failedRequest",
-                    "ERROR, {} code received from {}: {}".format(
-                        resp.status, url, text
-                    ),
-                )
-            return await resp.json()
+        """
+        Returns the decoded response. Responses are shared, callers must not modify them.
+        A response that did not change since the previous request is the very same object.
+        """
+        key = (url, tuple(sorted(params.items())))
+        if cls.ARCHIVE is not None and cls.ARCHIVE.replaying:
+            return await cls.single_flight(key, lambda: cls._replay(url, params))
+        if cls.RESPONSE_CACHE is not None:
+            cached = cls.RESPONSE_CACHE.get(key)
+            if cached is not None and cached.is_fresh():
+                endpoint = cls._endpoint(url)
+                metrics.CACHE_REQUESTS.inc(cache="response", result="hit")
+                metrics.RESPONSE_BYTES_SAVED.inc(cached.size, endpoint=endpoint)
+                if cls.ARCHIVE is not None:
+                    cls.ARCHIVE.record_unchanged(cls._archive_url(url), params)
+                return cached.value
+        return await cls.single_flight(key, lambda: cls._send_request(url, params, key))
+
+    @classmethod
+    async def _send_request(cls, url, params, key):
+        attempt = 0
+        while True:
+            try:
+                return await cls._send_request_once(url, params, key)
+            except RetryableError as e:
+                if attempt >= cls.RETRIES:
+                    raise RuntimeError("failedRequest", f"ERROR, giving up on {url} after {attempt + 1} attempts: {e}")
+                delay = cls._backoff(attempt)
+                attempt += 1
+                logging.getLogger(cls.__name__).info(
+                    f"Retrying {url} ({attempt}/{cls.RETRIES}) in {delay:.2f} seconds: {e}")
+                await asyncio.sleep(delay)
+
+    @classmethod
+    def _endpoint(cls, url):
+        """ Returns the kind of the url for metrics labels. """
+        if cls.AVAILABILITY_ENDPOINT in url:
+            return "availability"
+        return "rates" if url.endswith("rates") else "campground"
+
+    @classmethod
+    async def _send_request_once(cls, url, params, key):
+        timeout = aiohttp.ClientTimeout(total=cls.REQUEST_TIMEOUT)
+        endpoint = cls._endpoint(url)
+        metrics.REQUEST_BYTES.inc(len(url) + sum(len(k) + len(str(v)) + 2 for k, v in params.items()),
+                                  endpoint=endpoint)
+        cached = cls.RESPONSE_CACHE.get(key) if cls.RESPONSE_CACHE is not None else None
+        headers = cached.validators() if cached is not None else None
+        try:
+            async with cls.SCHEDULER.slot(url):
+                with metrics.REQUEST_SECONDS.time(endpoint=endpoint):
+                    async with cls.get_session().get(url, params=params, headers=headers, timeout=timeout) as resp:
+                        cls.SCHEDULER.on_response(url, resp.status, resp.headers.get("Retry-After"))
+                        metrics.RESPONSES.inc(endpoint=endpoint, status=resp.status)
+                        if resp.status == 304 and cached is not None:
+                            # Not modified: no body to download and nothing to decode
+                            metrics.CACHE_REQUESTS.inc(cache="response", result="revalidated")
+                            metrics.RESPONSE_BYTES_SAVED.inc(cached.size, endpoint=endpoint)
+                            if cls.ARCHIVE is not None:
+                                cls.ARCHIVE.record_unchanged(cls._archive_url(url), params)
+                            return cls.RESPONSE_CACHE.revalidated(cached, resp.headers).value
+                        if resp.status != 200:
+                            text = await resp.text()
+                            error = "ERROR, {} code received from {}: {}".format(resp.status, url, text)
+                            if resp.status == 429 or resp.status >= 500:
+                                raise RetryableError(error)
+                            raise RuntimeError("failedRequest", error)
+                        body = await resp.read()
+                        metrics.RESPONSE_BYTES.inc(len(body), endpoint=endpoint)
+                        # Content-Length is the compressed size, the decoded one stands in when it is missing
+                        size = int(resp.headers.get("Content-Length", len(body)))
+                        metrics.RESPONSE_WIRE_BYTES.inc(size, endpoint=endpoint)
+                        response_headers = resp.headers
+            value = json_loads(body)
+            if cls.ARCHIVE is not None:
+                cls.ARCHIVE.record(cls._archive_url(url), params, body)
+            if cls.RESPONSE_CACHE is not None:
+                metrics.CACHE_REQUESTS.inc(cache="response", result="miss")
+                cls.RESPONSE_CACHE.put(key, value, size, response_headers)
+            return value
+        except ValueError as e:
+            raise RetryableError(f"could not decode response: {e}")
+        except asyncio.TimeoutError:
+            metrics.RESPONSES.inc(endpoint=endpoint, status="timeout")
+            raise RetryableError(f"timed out after {cls.REQUEST_TIMEOUT} seconds")
+        except aiohttp.ClientError as e:
+            metrics.RESPONSES.inc(endpoint=endpoint, status="error")
+            raise RetryableError(f"{e.__class__.__name__}: {e}")
 
     @classmethod
     def _api_camp_url(cls, camp_id):
@@ -63,43 +322,44 @@ class Connection:
     def diff_month(self, start_date, end_date):
         return (end_date.year - start_date.year) * 12 + end_date.month - start_date.month
 
-    async def get_camp_information_month(self, camp_id, month_date):
+    def months(self):
+        """ Returns the first days of all the months covered by start_date..end_date. """
+        months = self.diff_month(self.start_date, self.end_date) + 1
+        return [(self.start_date + relativedelta(months=i)).replace(day=1) for i in range(months)]
+
+    @classmethod
+    async def get_camp_information_month(cls, camp_id, month_date):
         request_params = {
             "start_date": date_helper.format_date_request(month_date),
         }
-        self._logger.debug(
+        logging.getLogger(cls.__name__).debug(
             f"Querying for {camp_id} with these params: {request_params}")
-        camp_information = await self.send_request(
-            self._camp_avail_url(camp_id, month_date), request_params
-        )
+        cls.CAMP_BREAKER.check(camp_id)
+        try:
+            camp_information = await cls.send_request(
+                cls._camp_avail_url(camp_id, month_date), request_params
+            )
+        except Exception:
+            cls.CAMP_BREAKER.record_failure(camp_id)
+            raise
+        cls.CAMP_BREAKER.record_success(camp_id)
         return camp_information
 
     async def get_camp_information(self, camp_id):
-        months = self.diff_month(self.start_date, self.end_date) + 1
-        tasks = []
-        for i in range(months):
-            start_of_month = (self.start_date +
-                              relativedelta(months=i)).replace(day=1)
-            tasks.append(asyncio.create_task(
-                self.get_camp_information_month(camp_id, start_of_month)))
+        tasks = [asyncio.create_task(self.get_camp_information_month(camp_id, month))
+                 for month in self.months()]
         infos = await asyncio.gather(*tasks)
-        camp_information = {}
-        for info in infos:
-            if not camp_information:
-                camp_information = copy.deepcopy(info)
-                continue
-            for campsite_id, campsite_infos in info["campsites"].items():
-                if campsite_id not in camp_information["campsites"]:
-                    camp_information["campsites"][campsite_id] = campsite_infos
-                else:
-                    camp_information["campsites"][campsite_id]["availabilities"].update(
-                        campsite_infos["availabilities"])
-        camp_information["count"] = len(camp_information["campsites"])
-        self._logger.debug(
-            "Information for {}: {}".format(
-                camp_id, json.dumps(camp_information, indent=1)
+        return self.merge_months(camp_id, infos)
+
+    def merge_months(self, camp_id, infos):
+        """ See availability_matrix.merge_months, responses are not copied nor modified. """
+        camp_information = merge_months(infos)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(
+                "Information for {}: {}".format(
+                    camp_id, json.dumps(camp_information, indent=1, default=str)
+                )
             )
-        )
 
         return camp_information
 
@@ -108,24 +368,61 @@ class Connection:
         res = await asyncio.gather(*futures)
         return dict(zip(camp_ids, res))
 
-    async def get_camp_rates(self, camp_id):
-        if camp_id not in self.CAMP_RATES.keys():
-            self.CAMP_RATES[camp_id] = await self.send_request(
-                self._camp_rates_url(camp_id), {})
-        return self.CAMP_RATES[camp_id]
+    def fetch_plan(self, camp_ids):
+        """ Returns (camp_id, month) pairs needed to get information of camp_ids. """
+        return {(camp_id, month) for camp_id in camp_ids for month in self.months()}
+
+    @classmethod
+    async def get_planned_months(cls, plan, return_exceptions=False, spread_over=0):
+        """
+        Fetches every (camp_id, month) of the plan exactly once.
+        With return_exceptions failed months get their exception as a value instead of failing all of them.
+        Starts of the fetches are evenly spread over spread_over seconds instead of bursting at once.
+        """
+        plan = sorted(plan)
+        step = spread_over / len(plan) if plan else 0
+        futures = [cls._get_camp_information_month_delayed(camp_id, month, i * step)
+                   for i, (camp_id, month) in enumerate(plan)]
+        res = await asyncio.gather(*futures, return_exceptions=return_exceptions)
+        return dict(zip(plan, res))
+
+    @classmethod
+    async def _get_camp_information_month_delayed(cls, camp_id, month_date, delay):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return await cls.get_camp_information_month(camp_id, month_date)
+
+    @classmethod
+    async def get_camp_rates(cls, camp_id):
+        return await cls._get_metadata("rates", camp_id, cls.CAMP_RATES, cls._fetch_camp_rates)
+
+    @classmethod
+    async def get_camp_rate_index(cls, camp_id):
+        """ Returns rates of the camp compiled into a RateIndex, shared by all the user requests. """
+        if camp_id not in cls.CAMP_RATE_INDEXES:
+            rates = await cls.get_camp_rates(camp_id)
+            if camp_id not in cls.CAMP_RATE_INDEXES:
+                cls.CAMP_RATE_INDEXES[camp_id] = RateIndex(rates)
+        return cls.CAMP_RATE_INDEXES[camp_id]
+
+    @classmethod
+    async def _fetch_camp_rates(cls, camp_id):
+        cls.CAMP_RATES[camp_id] = await cls.send_request(cls._camp_rates_url(camp_id), {})
 
     @classmethod
-    async def get_camps_names(cls, camp_ids):
+    async def get_camps_names(cls, camp_ids, return_exceptions=False):
         futures = [cls.get_camp_name(pid) for pid in camp_ids]
-        res = await asyncio.gather(*futures)
+        res = await asyncio.gather(*futures, return_exceptions=return_exceptions)
         return dict(zip(camp_ids, res))
 
     @classmethod
     async def get_camp_name(cls, camp_id):
-        if camp_id not in cls.CAMP_NAMES:
-            resp = await cls.send_request(cls._api_camp_url(camp_id), {})
-            cls.CAMP_NAMES[camp_id] = resp["campground"]["facility_name"]
-        return cls.CAMP_NAMES[camp_id]
+        return await cls._get_metadata("name", camp_id, cls.CAMP_NAMES, cls._fetch_camp_name)
+
+    @classmethod
+    async def _fetch_camp_name(cls, camp_id):
+        resp = await cls.send_request(cls._api_camp_url(camp_id), {})
+        cls.CAMP_NAMES[camp_id] = resp["campground"]["facility_name"]
 
     @classmethod
     def campsite_url(cls, camp_id):
@@ -0,0 +1,110 @@
+import hmac
+import json
+import logging
+import os
+import uuid
+
+
+class ControlServer:
+    """
+    Local HTTP API to manage watches of a running Crawler, on 127.0.0.1:port or a unix socket:
+    - GET /watches - list the watches
+    - POST /watches - add a watch, the body is a JSON object of Watch.FIELDS (Content-Type: application/json),
+      an id is made up if missing
+    - GET /watches/<id> - show a watch
+    - DELETE /watches/<id> - remove a watch, what it has queued is still delivered
+    With a token every request needs an "Authorization: Bearer <token>" header. A port is only served with
+    a token, as any local process or web page can reach it, the unix socket is made accessible to its owner
+    only. Settings writing to the box, NOT_ALLOWED, can not be set through the API.
+    """
+    NOT_ALLOWED = ("notify_file",)
+
+    def __init__(self, crawler, port: int = 0, unix_socket: str = "", host: str = "127.0.0.1", token: str = ""):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        if port and not unix_socket and not token:
+            raise ValueError("The control API is served on a port only with a token, set --control_token "
+                             "or use --control_socket")
+        self._crawler = crawler
+        self._port = port
+        self._unix_socket = unix_socket
+        self._host = host
+        self._token = token
+        self._runner = None
+
+    @staticmethod
+    def _json(data, status: int = 200):
+        from aiohttp import web
+        return web.json_response(data, status=status)
+
+    async def _list(self, request):
+        return self._json([watch.to_dict() for watch in self._crawler.watches])
+
+    async def _get(self, request):
+        watch = self._crawler.watch(request.match_info["watch_id"])
+        if watch is None:
+            return self._json({"error": "No such watch"}, 404)
+        return self._json(watch.to_dict())
+
+    def _authorized(self, request) -> bool:
+        if not self._token:
+            return True
+        return hmac.compare_digest(request.headers.get("Authorization", "").encode(),
+                                   f"Bearer {self._token}".encode())
+
+    async def _add(self, request):
+        if request.content_type != "application/json":
+            return self._json({"error": "Expected Content-Type: application/json"}, 415)
+        try:
+            config = await request.json()
+        except json.JSONDecodeError as e:
+            return self._json({"error": f"Not valid JSON: {e}"}, 400)
+        if not isinstance(config, dict):
+            return self._json({"error": "Expected a JSON object"}, 400)
+        not_allowed = sorted(set(config) & set(self.NOT_ALLOWED))
+        if not_allowed:
+            return self._json({"error": f"Not allowed through the control API: {', '.join(not_allowed)}"}, 403)
+        config.setdefault("id", uuid.uuid4().hex[:8])
+        try:
+            watch = self._crawler.make_watch(config)
+            self._crawler.add_watch(watch)
+        except ValueError as e:
+            return self._json({"error": str(e)}, 400)
+        self._logger.info(f"Added watch {watch.id}: {watch.request_str}")
+        return self._json(watch.to_dict(), 201)
+
+    async def _remove(self, request):
+        watch_id = request.match_info["watch_id"]
+        if await self._crawler.remove_watch(watch_id) is None:
+            return self._json({"error": "No such watch"}, 404)
+        self._logger.info(f"Removed watch {watch_id}")
+        return self._json({"id": watch_id})
+
+    async def start(self) -> None:
+        # aiohttp.web is slow to import and only needed when the API is served
+        from aiohttp import web
+
+        @web.middleware
+        async def authorize(request, handler):
+            if not self._authorized(request):
+                return self._json({"error": "Not authorized"}, 401)
+            return await handler(request)
+
+        app = web.Application(middlewares=[authorize])
+        app.router.add_get("/watches", self._list)
+        app.router.add_post("/watches", self._add)
+        app.router.add_get("/watches/{watch_id}", self._get)
+        app.router.add_delete("/watches/{watch_id}", self._remove)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        if self._unix_socket:
+            await web.UnixSite(self._runner, self._unix_socket).start()
+            os.chmod(self._unix_socket, 0o600)
+            self._logger.info(f"Control API is listening at {self._unix_socket}")
+        else:
+            await web.TCPSite(self._runner, self._host, self._port).start()
+            self._logger.info(f"Control API is listening at http://{self._host}:{self._port}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -3,111 +3,461 @@
 import asyncio
 import datetime
 import logging
-import os
-import time
-import tempfile
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
-import telegram_send
+from availability_matrix import AvailabilityMatrix
+import metrics
+from connection import Connection
+from metadata_cache import MetadataCache
+from control_api import ControlServer
+from history_store import HistoryStore
+from poll_scheduler import PollScheduler
+from response_archive import ResponseArchive
+from shards import ShardPool
+from notifications import make_sinks
+from pipeline import CampPipeline
 from user_request import UserRequest, UseType, CampsiteType
+from watch import Watch
+from watch_file import WatchFile
 
 
 class Crawler:
     def __init__(self, request_str: str, only_available: bool, no_overall: bool, html: bool,
                  telegram_token: str, telegram_chat_id: str, skip_use_type: Optional[UseType],
-                 skip_campsite_types: Optional[CampsiteType]):
+                 skip_campsite_types: Optional[CampsiteType],
+                 max_concurrency: int = Connection.DEFAULT_MAX_CONCURRENCY,
+                 max_rps: float = Connection.DEFAULT_MAX_RPS,
+                 request_timeout: float = Connection.DEFAULT_REQUEST_TIMEOUT,
+                 retries: int = Connection.DEFAULT_RETRIES,
+                 tolerate_failures: bool = False,
+                 webhook_url: str = "",
+                 notify_file: str = "",
+                 notify_batch_window: float = 2,
+                 metadata_cache: str = "",
+                 metadata_cache_ttl: float = 7 * 24 * 60 * 60,
+                 metadata_cache_size: int = 10000,
+                 only_changes: bool = False,
+                 metrics_port: int = 0,
+                 metrics_summary_every: float = 10 * 60,
+                 connection_limit: int = Connection.DEFAULT_CONNECTION_LIMIT,
+                 connection_limit_per_host: int = Connection.DEFAULT_CONNECTION_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = Connection.DEFAULT_DNS_CACHE_TTL,
+                 keepalive_timeout: float = Connection.DEFAULT_KEEPALIVE_TIMEOUT,
+                 compress: bool = True,
+                 response_cache_size: int = Connection.DEFAULT_RESPONSE_CACHE_SIZE,
+                 adaptive_polling: bool = False,
+                 min_poll_interval: float = 0,
+                 max_poll_interval: float = 30 * 60,
+                 poll_budget: int = 0,
+                 control_port: int = 0,
+                 control_socket: str = "",
+                 control_token: str = "",
+                 workers: int = 0,
+                 pipeline_depth: int = 32,
+                 watch_file: str = "",
+                 watch_file_check_every: float = 5,
+                 record: str = "",
+                 replay: str = "",
+                 history_dir: str = ""):
         self._logger = logging.getLogger(self.__class__.__name__)
-        self._user_requests = UserRequest.make_user_requests(
-            request_str, only_available, no_overall, html, skip_use_type, skip_campsite_types)
-        self._telegram_config: str = self._gen_telegram_config(
-            telegram_token, telegram_chat_id)
-        self._telegram_html = html
+        Connection.configure_scheduler(max_concurrency, max_rps)
+        Connection.configure_retries(request_timeout, retries)
+        Connection.configure_session(connection_limit, connection_limit_per_host, dns_cache_ttl,
+                                     keepalive_timeout, compress)
+        self._tolerate_failures = tolerate_failures
+        self._metadata_cache: Optional[MetadataCache] = None
+        if metadata_cache:
+            self._metadata_cache = MetadataCache(metadata_cache, metadata_cache_ttl, metadata_cache_size)
+        Connection.configure_metadata_cache(self._metadata_cache)
+        # Settings of watches added later that do not set them
+        self._watch_defaults = {
+            "only_available": only_available,
+            "no_overall": no_overall,
+            "html": html,
+            "skip_use_type": skip_use_type,
+            "skip_campsite_types": skip_campsite_types,
+            "notify_batch_window": notify_batch_window,
+            "only_changes": only_changes,
+        }
+        self._watches: Dict[str, Watch] = {}
+        self._running = False
+        if request_str:
+            self.add_watch(Watch(
+                self.DEFAULT_WATCH, request_str, only_available, no_overall, html, skip_use_type,
+                skip_campsite_types, make_sinks(telegram_token, telegram_chat_id, html, webhook_url, notify_file),
+                notify_batch_window, only_changes))
+        self._watch_file: Optional[WatchFile] = None
+        if watch_file:
+            self._watch_file = WatchFile(self, watch_file, watch_file_check_every)
+            self._watch_file.load()
         self._sent_into_at = datetime.datetime.fromtimestamp(0)
+        self._metrics_server: Optional[metrics.MetricsServer] = \
+            metrics.MetricsServer(metrics_port) if metrics_port else None
+        self._metrics_summary_every = metrics_summary_every
+        Connection.configure_response_cache(response_cache_size)
+        # Matrices of camps whose months did not change are reused across cycles
+        self._matrices: Dict[int, Tuple[List[dict], AvailabilityMatrix]] = {}
+        self._adaptive_polling = adaptive_polling
+        self._min_poll_interval = min_poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._poll_budget = poll_budget
+        self._poll_scheduler: Optional[PollScheduler] = None
+        if workers and adaptive_polling:
+            raise ValueError("Adaptive polling is not supported with workers")
+        if record and replay:
+            raise ValueError("Responses can not be recorded and replayed at the same time")
+        if workers and (record or replay):
+            raise ValueError("Recording and replaying are not supported with workers")
+        if workers and history_dir:
+            raise ValueError("Availability history is not supported with workers")
+        self._history: Optional[HistoryStore] = HistoryStore(history_dir) if history_dir else None
+        self._archive: Optional[ResponseArchive] = None
+        if record or replay:
+            self._archive = ResponseArchive(record or replay, replaying=bool(replay))
+        Connection.configure_archive(self._archive)
+        # Workers are started with the settings when the Crawler is entered
+        self._workers = workers
+        self._worker_settings = {
+            "max_concurrency": max_concurrency,
+            "max_rps": max_rps,
+            "request_timeout": request_timeout,
+            "retries": retries,
+            "connection_limit": connection_limit,
+            "connection_limit_per_host": connection_limit_per_host,
+            "dns_cache_ttl": dns_cache_ttl,
+            "keepalive_timeout": keepalive_timeout,
+            "compress": compress,
+            "response_cache_size": response_cache_size,
+            "metadata_cache": metadata_cache,
+            "metadata_cache_ttl": metadata_cache_ttl,
+            "metadata_cache_size": metadata_cache_size,
+        }
+        self._shards: Optional[ShardPool] = None
+        self._pipeline_depth = pipeline_depth
+        self._control_server: Optional[ControlServer] = None
+        if control_port or control_socket:
+            self._control_server = ControlServer(self, control_port, control_socket, token=control_token)
 
-    async def crawl_loop(self, check_freq, dont_recheck_avail_for, send_info_every) -> None:
-        sleep_time: int
+    # Id of the watch made of the request_str Crawler is created with
+    DEFAULT_WATCH = "default"
+
+    @property
+    def watches(self) -> List[Watch]:
+        return list(self._watches.values())
+
+    def watch(self, watch_id: str) -> Optional[Watch]:
+        return self._watches.get(watch_id)
+
+    def make_watch(self, config: dict) -> Watch:
+        """ Returns Watch.from_dict of the config with the settings missing taken from the Crawler ones. """
+        return Watch.from_dict(config, self._watch_defaults)
+
+    def add_watch(self, watch: Watch) -> None:
+        """ Adds the watch, it is checked from the next cycle on. """
+        if watch.id in self._watches:
+            raise ValueError(f"There is a watch {watch.id} already")
+        self._watches[watch.id] = watch
+        if self._running:
+            watch.notifications.start()
+        metrics.WATCHES.set(len(self._watches))
+
+    async def remove_watch(self, watch_id: str) -> Optional[Watch]:
+        """ Removes the watch and delivers what it has queued, returns None if there is no such watch. """
+        watch = self._watches.pop(watch_id, None)
+        if watch is not None:
+            metrics.WATCHES.set(len(self._watches))
+            if self._running:
+                await watch.notifications.close()
+        return watch
+
+    # Warn when a cycle takes this share of check_freq
+    SLOW_CYCLE_RATIO = 0.9
+
+    async def crawl_loop(self, check_freq, dont_recheck_avail_for, send_info_every,
+                         spread_requests: float = 0) -> None:
+        """
+        Crawls every check_freq seconds counted from the start of each cycle.
+        The requests of a cycle are spread over spread_requests * check_freq seconds.
+        With adaptive polling a cycle fetches only the camp months due according to PollScheduler.
+        When replaying an archive cycles run back to back on its recorded clock until all of it is replayed,
+        or until a cycle replays nothing new.
+        """
+        replaying = self._archive is not None and self._archive.replaying
+        loop = asyncio.get_event_loop()
+        if self._adaptive_polling:
+            self._poll_scheduler = PollScheduler(
+                self._min_poll_interval or check_freq, self._max_poll_interval, self._poll_budget)
+        info_task: Optional[asyncio.Task] = None
+        next_start = loop.time()
+        summary_at = loop.time()
+        metrics.CHECK_FREQ_SECONDS.set(check_freq)
         while True:
-            start_time = datetime.datetime.now()
-            if self._sent_into_at < datetime.datetime.now() - datetime.timedelta(hours=send_info_every):
+            start_time = loop.time()
+            saved_bytes = metrics.RESPONSE_BYTES_SAVED.total()
+            if self._sent_into_at < datetime.datetime.now() - datetime.timedelta(hours=send_info_every) and \
+                    (info_task is None or info_task.done()):
                 self._logger.info("Time to get search info")
-                await self.crawl_info()
                 self._sent_into_at = datetime.datetime.now()
+                info_task = asyncio.ensure_future(self.crawl_info())
+                info_task.add_done_callback(self._log_task_error)
             self._logger.info("Getting availabilities")
-            availabilities = await self.crawl(dont_recheck_avail_for)
-            sleep_time = check_freq
-            end_time = datetime.datetime.now()
-            time_diff = end_time - start_time
+            remaining_before = self._archive.remaining() if replaying else 0
+            await self.crawl(dont_recheck_avail_for, spread_over=0 if replaying else check_freq * spread_requests)
+            cycle_time = loop.time() - start_time
+            metrics.CYCLE_SECONDS.observe(cycle_time)
+            metrics.LAST_CYCLE_SECONDS.set(cycle_time)
+            saved_bytes = metrics.RESPONSE_BYTES_SAVED.total() - saved_bytes
+            metrics.LAST_CYCLE_SAVED_BYTES.set(saved_bytes)
             self._logger.debug(
-                f"Crawler loop took {time_diff.seconds}.{time_diff.microseconds} seconds")
+                f"Crawler loop took {cycle_time:.3f} seconds, cached responses saved {saved_bytes / 1024:.1f} KiB")
+            if cycle_time >= check_freq * self.SLOW_CYCLE_RATIO:
+                self._logger.warning(
+                    f"Crawler loop took {cycle_time:.3f} seconds, close to check_freq of {check_freq} seconds")
+            if self._metadata_cache is not None:
+                self._logger.debug(self._metadata_cache.stats())
+            if self._poll_scheduler is not None:
+                self._logger.debug(f"Adaptive polling: {self._poll_scheduler.stats()}")
+            if loop.time() - summary_at >= self._metrics_summary_every:
+                summary_at = loop.time()
+                self._logger.info(f"Metrics: {metrics.summary()}")
+            if replaying:
+                remaining = self._archive.remaining()
+                if not remaining:
+                    self._logger.info(f"Replayed all of {self._archive.path}")
+                    return
+                if remaining == remaining_before:
+                    # Nothing was due at the recorded time, the clock would not move on
+                    self._logger.warning(f"Stopping the replay, the last check used nothing of {self._archive.path}, "
+                                         f"{remaining} recorded responses are left")
+                    return
+                await asyncio.sleep(0)
+                continue
+            next_start += check_freq
+            now = loop.time()
+            if next_start <= now:
+                skipped = int((now - next_start) // check_freq) + 1
+                self._logger.warning(
+                    f"Crawler loop is {now - next_start:.3f} seconds late, skipping {skipped} cycle(s)")
+                next_start += skipped * check_freq
             self._logger.debug(
-                f"Sleeping for {sleep_time} seconds before the next iteration")
-            time.sleep(sleep_time)
+                f"Sleeping for {next_start - now:.3f} seconds before the next iteration")
+            await asyncio.sleep(next_start - now)
+
+    def _clock(self) -> Optional[float]:
+        """ Returns the recorded time of the cycle when replaying, None when checks run on the real clock. """
+        if self._archive is not None and self._archive.replaying:
+            return self._archive.clock
+        return None
+
+    def _now(self) -> datetime.datetime:
+        clock = self._clock()
+        return datetime.datetime.now() if clock is None else datetime.datetime.fromtimestamp(clock)
 
-    async def crawl(self, skip_avails_less_than: int = 15 * 60) -> None:
+    async def crawl(self, skip_avails_less_than: int = 15 * 60, spread_over: float = 0) -> None:
         availabilities = False
-        threshold = datetime.datetime.now() - datetime.timedelta(seconds=skip_avails_less_than)
-        requests_above_threshold = [
-            x for x in self._user_requests_in_future() if x.available_at < threshold]
-        futures = [x.process_request() for x in sorted(
-            requests_above_threshold, key=lambda us: us.start_date)]
-        self._logger.debug(
-            f"Getting availability for {len(futures)} user requests")
-        all_out: str = ""
-        for avail, out in await asyncio.gather(*futures):
-            availabilities = availabilities or avail
-            all_out += out
-        if availabilities:
-            await self._send_to_telegram_or_print(all_out)
-        self._logger.info(all_out)
+        if self._archive is not None and self._archive.replaying:
+            self._archive.tick()
+        now = self._now()
+        # Found availability is dated with the recorded time when replaying, with the current one otherwise
+        checked_at = now if self._clock() is not None else None
+        watches = self.watches
+        watches_requests: List[List[UserRequest]] = []
+        for watch in watches:
+            # Only changes are reported with snapshots, so there is no need to stop checking what was announced
+            skip = 0 if watch.snapshots is not None else skip_avails_less_than
+            threshold = now - datetime.timedelta(seconds=skip)
+            watches_requests.append([x for x in watch.user_requests_in_future(now.date()) if x.available_at < threshold])
+        requests_above_threshold = [x for requests in watches_requests for x in requests]
+        # Watches asking for the same camps share the fetches
+        plan = set()
+        for user_request in requests_above_threshold:
+            plan |= user_request.fetch_plan()
+        jobs = [(watch, i, x) for watch, requests in zip(watches, watches_requests) for i, x in enumerate(requests)]
+        if self._shards is not None:
+            self._logger.debug(
+                f"Evaluating {len(plan)} distinct camp months for {len(requests_above_threshold)} user requests "
+                f"of {len(watches)} watch(es) on {len(self._shards.workers)} workers")
+            results, _ = await asyncio.gather(
+                self._shards.evaluate([((watch.id, i), x) for watch, i, x in jobs], self._tolerate_failures,
+                                      spread_over),
+                asyncio.gather(*[x.camp_names(self._tolerate_failures) for x in requests_above_threshold])
+            )
+            lines = {}
+            for watch, i, x in jobs:
+                camps_names = await x.camp_names(self._tolerate_failures)
+                lines[(watch.id, i)] = {
+                    camp_id: x.render_camp(camp_id, results[(watch.id, i)][camp_id], camps_names[camp_id],
+                                           self._tolerate_failures, watch.snapshots, checked_at)
+                    for camp_id in x.camp_ids
+                }
+        else:
+            lines = await self._stream(jobs, plan, spread_over, checked_at)
+        for watch, requests in zip(watches, watches_requests):
+            self._logger.debug(
+                f"Getting availability for {len(requests)} user requests of watch {watch.id}")
+            watch_availabilities = False
+            all_out: str = ""
+            for i, x in sorted(enumerate(requests), key=lambda us: us[1].start_date):
+                camps_lines = lines[(watch.id, i)]
+                avail, out = x.compose([line for camp_id in x.camp_ids for line in camps_lines[camp_id][0]],
+                                       [line for camp_id in x.camp_ids for line in camps_lines[camp_id][1]],
+                                       watch.snapshots)
+                watch_availabilities = watch_availabilities or avail
+                all_out += out
+            # Streamed checks have notified the watches already, the watch may have been removed meanwhile
+            if watch_availabilities and self._shards is not None and self._watches.get(watch.id) is watch:
+                watch.notify(all_out)
+            availabilities = availabilities or watch_availabilities
+            self._logger.info(all_out if len(watches) == 1 else f"Watch {watch.id}:\n{all_out}")
+        if self._shards is None:
+            # Sites of the requests skipped this time are kept, they are checked again soon
+            UserRequest.SITES.retain(
+                x for watch in watches for user_request in watch.user_requests_in_future(now.date())
+                for x in user_request.site_dates())
 
         return availabilities
 
+    async def _stream(self, jobs: List[Tuple[Watch, int, UserRequest]], plan, spread_over: float,
+                      checked_at: Optional[datetime.datetime] = None) -> Dict[Tuple[str, int], Dict[int, Tuple[List[str], List[str]]]]:
+        """
+        Fetches the plan camp by camp with CampPipeline, a camp is evaluated as soon as its months arrive
+        and its lines are sent to the watches right away. The overall line of a request is sent once per check,
+        with its first camp. The watches something was sent to get the rest of the report at the end of
+        the check, the stale camps and the overall lines of the requests with nothing to report, so they get
+        the same lines as with --workers.
+        Returns (watch id, request index) -> camp_id -> UserRequest.render_camp lines.
+        """
+        due = plan if self._poll_scheduler is None else self._poll_scheduler.due(plan, self._clock())
+        self._logger.debug(f"Fetching {len(due)} of {len(plan)} distinct camp months for {len(jobs)} user requests")
+        camps: Dict[int, List[datetime.datetime]] = {}
+        for camp_id, month in sorted(plan):
+            camps.setdefault(camp_id, []).append(month)
+        camps_jobs: Dict[int, List[Tuple[Watch, int, UserRequest]]] = {}
+        for job in jobs:
+            for camp_id in job[2].camp_ids:
+                camps_jobs.setdefault(camp_id, []).append(job)
+        ret = {(watch.id, i): {} for watch, i, _ in jobs}
+        # Jobs whose overall line was sent in this check
+        headed: Set[Tuple[str, int]] = set()
+
+        async def fetch(camp_id, months):
+            months_info, name_of_camp = await asyncio.gather(
+                Connection.get_planned_months(
+                    {(camp_id, x) for x in months if (camp_id, x) in due}, return_exceptions=self._tolerate_failures),
+                Connection.get_camp_name(camp_id),
+                return_exceptions=True)
+            if isinstance(months_info, Exception):
+                raise months_info
+            if isinstance(name_of_camp, Exception):
+                if not self._tolerate_failures:
+                    raise name_of_camp
+                # Same fall back as UserRequest.camp_names
+                name_of_camp = str(camp_id)
+            infos = []
+            for month in months:
+                key = (camp_id, month)
+                if key not in months_info:
+                    # Not due, checked again as it was last fetched
+                    infos.append(self._poll_scheduler.payload(key))
+                    continue
+                if self._poll_scheduler is not None and not isinstance(months_info[key], Exception):
+                    self._poll_scheduler.record(key, months_info[key], self._clock(), self._now())
+                infos.append(months_info[key])
+            return name_of_camp, infos
+
+        async def consume(camp_id, fetched):
+            name_of_camp, infos = fetched
+            with metrics.PHASE_SECONDS.time(phase="merge"):
+                matrix = AvailabilityMatrix.for_camp(camp_id, infos, self._matrices)
+            if self._history is not None and not isinstance(matrix, Exception):
+                self._history.record(camp_id, matrix, at=self._clock())
+            for watch, i, user_request in camps_jobs[camp_id]:
+                result = (await user_request.evaluate({camp_id: matrix}, [camp_id]))[camp_id]
+                out, stale = user_request.render_camp(
+                    camp_id, result, name_of_camp, self._tolerate_failures, watch.snapshots, checked_at)
+                ret[(watch.id, i)][camp_id] = (out, stale)
+                if out and self._watches.get(watch.id) is watch:
+                    watch.notify(self._stream_message(user_request, out, [], watch.snapshots, (watch.id, i), headed))
+
+        try:
+            await CampPipeline(self._pipeline_depth).run(camps, fetch, consume, spread_over)
+        finally:
+            if self._history is not None:
+                self._history.flush()
+        for camp_id in set(self._matrices) - set(camps):
+            del self._matrices[camp_id]
+        notified = {watch_id for watch_id, _ in headed}
+        for watch, i, user_request in jobs:
+            if watch.id not in notified or self._watches.get(watch.id) is not watch:
+                continue
+            stale = [line for camp_id in user_request.camp_ids for line in ret[(watch.id, i)][camp_id][1]]
+            if stale or (watch.id, i) not in headed:
+                message = self._stream_message(user_request, [], stale, watch.snapshots, (watch.id, i), headed)
+                if message.strip():
+                    watch.notify(message)
+        return ret
+
+    @staticmethod
+    def _stream_message(user_request: UserRequest, out: List[str], stale: List[str], snapshots,
+                        job_id: Tuple[str, int], headed: Set[Tuple[str, int]]) -> str:
+        """ Returns the render_camp lines with the overall line of the request if it was not sent in this check yet. """
+        if job_id in headed:
+            return "\n".join(out + stale) + "\n"
+        headed.add(job_id)
+        return user_request.compose(out, stale, snapshots)[1]
+
     async def crawl_info(self) -> None:
-        info: str = ""
-        futures = [x.get_camps_names() for x in sorted(
-            self._user_requests_in_future(), key=lambda us: us.start_date)]
-        for res in await asyncio.gather(*futures):
-            info += res
-        self._logger.info(info)
-        await self._send_to_telegram_or_print(info)
-
-    def _user_requests_in_future(self) -> List[UserRequest]:
-        tomorrow = datetime.datetime.combine(
-            datetime.date.today() + datetime.timedelta(days=1),
-            datetime.datetime.min.time()
-        )
-        return [x for x in self._user_requests if datetime.datetime.strptime(x.start_date, '%Y-%m-%d') >= tomorrow]
-
-    def _gen_telegram_config(self, token, chat_id) -> str:
-        tmp_path: str = ""
-        if token and chat_id:
-            self._logger.info("Generating telegram config")
-            tmp_handle, tmp_path = tempfile.mkstemp()
-            with os.fdopen(tmp_handle, 'w') as fh:
-                print(
-                    f"[telegram]\ntoken = {token}\nchat_id = {chat_id}\n", file=fh)
-        return tmp_path
-
-    async def _send_to_telegram_or_print(self, message: str):
-        if self._telegram_config:
-            self._logger.debug("Sending a message to telegram chat")
-            if len(message) < 4096:
-                messages = [message]
-            else:
-                lines = message.splitlines()
-                message = ""
-                messages = []
-                for line in lines:
-                    if len(message) + len(line) + 2 >= 4096:
-                        messages.append(message)
-                        message = ""
-                    message += f"\n{line}"
-                messages.append(message)
-            telegram_send.send(
-                messages=messages,
-                conf=self._telegram_config,
-                parse_mode="html" if self._telegram_html else "text"
-            )
-        else:
-            print(message)
+        for watch in self.watches:
+            info: str = ""
+            futures = [x.get_camps_names() for x in sorted(
+                watch.user_requests_in_future(self._now().date()), key=lambda us: us.start_date)]
+            for res in await asyncio.gather(*futures):
+                info += res
+            self._logger.info(info)
+            if info and self._watches.get(watch.id) is watch:
+                watch.notify(info)
+
+    def _log_task_error(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            self._logger.error(f"Background task failed: {task.exception()}")
+
+    async def __aenter__(self) -> "Crawler":
+        Connection.open_session()
+        self._running = True
+        for watch in self.watches:
+            watch.notifications.start()
+        if self._workers:
+            settings = dict(self._worker_settings, base_url=Connection.BASE_URL,
+                            log_level=logging.getLogger().getEffectiveLevel())
+            self._shards = ShardPool(self._workers, settings)
+            self._shards.start()
+        if self._metrics_server is not None:
+            await self._metrics_server.start()
+        if self._control_server is not None:
+            await self._control_server.start()
+        if self._watch_file is not None:
+            await self._watch_file.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        if self._watch_file is not None:
+            await self._watch_file.stop()
+        if self._control_server is not None:
+            await self._control_server.stop()
+        self._running = False
+        await asyncio.gather(*[watch.notifications.close() for watch in self.watches])
+        if self._shards is not None:
+            await self._shards.close()
+            self._shards = None
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+        await Connection.close_session()
+        if self._history is not None:
+            self._history.close()
+        if self._archive is not None:
+            self._logger.info(self._archive.stats())
+            self._archive.close()
+        if self._metadata_cache is not None:
+            self._logger.info(self._metadata_cache.stats())
+            self._metadata_cache.close()
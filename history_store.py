@@ -0,0 +1,181 @@
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from availability_matrix import AvailabilityMatrix
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class HistoryStore:
+    """
+    Append-only history of availability changes: a row per site night that opened or was taken between
+    two polls of a camp, 15 bytes a row in a fixed width file per column in the directory:
+    - at.u4 - poll time, unix seconds
+    - camp.u4, site.u4 - camp and campsite ids
+    - night.u2 - the night, days since 1970-01-01
+    - event.u1 - OPENED or TAKEN
+    Only the nights both polls cover are compared, and the first poll of a camp after a start only sets
+    what the next one is compared with. Queries memory-map the columns and scan them CHUNK_ROWS rows at a
+    time, so they need the same memory for a week of history and for a year.
+    A read only store, for queries, changes nothing on disk: rows a writer has not finished appending to all
+    the columns yet are left out.
+    """
+    COLUMNS = (("at", np.uint32), ("camp", np.uint32), ("site", np.uint32), ("night", np.uint16),
+               ("event", np.uint8))
+    OPENED = 1
+    TAKEN = 0
+    CHUNK_ROWS = 1 << 20
+    MAX_LEAD_DAYS = 180
+    BUCKETS = {"hour": 24, "weekday": 7, "lead_days": MAX_LEAD_DAYS + 1}
+    WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+    def __init__(self, directory: str, read_only: bool = False):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        self.read_only = read_only
+        if read_only:
+            if not os.path.isdir(directory):
+                raise ValueError(f"There is no history in {directory}, no such directory")
+        else:
+            os.makedirs(directory, exist_ok=True)
+        # camp_id -> (matrix, its (site, night) keys available, first night, end night)
+        self._last: Dict[int, Tuple[AvailabilityMatrix, np.ndarray, int, int]] = {}
+        self._pending: List[Dict[str, np.ndarray]] = []
+        if not read_only:
+            self._repair()
+
+    def _path(self, column: str, dtype) -> str:
+        return os.path.join(self.directory, f"{column}.{np.dtype(dtype).kind}{np.dtype(dtype).itemsize}")
+
+    def _rows(self, column: str, dtype) -> int:
+        path = self._path(column, dtype)
+        return os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0
+
+    def __len__(self) -> int:
+        return min(self._rows(column, dtype) for column, dtype in self.COLUMNS)
+
+    def _repair(self) -> None:
+        """ Cuts the columns to the same number of rows, a crash may have left some of them longer. """
+        rows = len(self)
+        for column, dtype in self.COLUMNS:
+            if self._rows(column, dtype) != rows:
+                self._logger.warning(f"Dropping a partially written row of {self._path(column, dtype)}")
+                with open(self._path(column, dtype), "r+b") as f:
+                    f.truncate(rows * np.dtype(dtype).itemsize)
+
+    def record(self, camp_id: int, matrix: AvailabilityMatrix, at: Optional[float] = None) -> int:
+        """ Compares the matrix with the previous one of the camp, returns the number of changes found. """
+        if self.read_only:
+            raise ValueError(f"The history in {self.directory} is opened read only")
+        last = self._last.get(camp_id)
+        if matrix.first_day is None or (last is not None and last[0] is matrix):
+            return 0
+        rows, columns = np.nonzero(matrix.available)
+        site_ids = np.array([int(site["campsite_id"]) for site in matrix.sites], dtype=np.int64)
+        first = (matrix.first_day - EPOCH).days
+        end = first + matrix.available.shape[1]
+        keys = site_ids[rows] << 16 | (first + columns)
+        self._last[camp_id] = (matrix, keys, first, end)
+        if last is None:
+            return 0
+        _, last_keys, last_first, last_end = last
+        start, stop = max(first, last_first), min(end, last_end)
+
+        def covered(x: np.ndarray) -> np.ndarray:
+            nights = x & 0xFFFF
+            return x[(nights >= start) & (nights < stop)]
+
+        current, previous = covered(keys), covered(last_keys)
+        opened = np.setdiff1d(current, previous, assume_unique=True)
+        taken = np.setdiff1d(previous, current, assume_unique=True)
+        changes = np.concatenate([opened, taken])
+        if not len(changes):
+            return 0
+        self._pending.append({
+            "at": np.full(len(changes), int(time.time() if at is None else at), dtype=np.uint32),
+            "camp": np.full(len(changes), camp_id, dtype=np.uint32),
+            "site": (changes >> 16).astype(np.uint32),
+            "night": (changes & 0xFFFF).astype(np.uint16),
+            "event": np.concatenate([np.full(len(opened), self.OPENED, dtype=np.uint8),
+                                     np.full(len(taken), self.TAKEN, dtype=np.uint8)]),
+        })
+        return len(changes)
+
+    def flush(self) -> None:
+        """ Appends the changes recorded so far to the files. """
+        if not self._pending:
+            return
+        for column, dtype in self.COLUMNS:
+            with open(self._path(column, dtype), "ab") as f:
+                for rows in self._pending:
+                    f.write(rows[column].astype(dtype, copy=False).tobytes())
+        self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+
+    def _scan(self) -> Iterator[Dict[str, np.ndarray]]:
+        """ Yields the columns CHUNK_ROWS rows at a time. """
+        rows = len(self)
+        if not rows:
+            return
+        columns = {column: np.memmap(self._path(column, dtype), dtype=dtype, mode="r", shape=(rows,))
+                   for column, dtype in self.COLUMNS}
+        for start in range(0, rows, self.CHUNK_ROWS):
+            yield {column: np.asarray(x[start:start + self.CHUNK_ROWS]) for column, x in columns.items()}
+
+    def histogram(self, by: str = "hour", camp_id: Optional[int] = None, event: int = OPENED,
+                  since: Optional[datetime] = None, utc_offset: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the number of events per hour of day, weekday (Monday first) or days between the poll and
+        the night (lead_days, the last bucket takes the longer ones). Hours and weekdays are shifted by
+        utc_offset secs, the local one by default.
+        """
+        if by not in self.BUCKETS:
+            raise ValueError(f"Not a valid grouping: '{by}', expected one of {', '.join(self.BUCKETS)}")
+        if utc_offset is None:
+            utc_offset = time.localtime().tm_gmtoff
+        buckets = self.BUCKETS[by]
+        counts = np.zeros(buckets, dtype=np.int64)
+        for chunk in self._scan():
+            mask = chunk["event"] == event
+            if camp_id is not None:
+                mask &= chunk["camp"] == camp_id
+            if since is not None:
+                mask &= chunk["at"] >= int(since.timestamp())
+            at = chunk["at"][mask].astype(np.int64)
+            if by == "lead_days":
+                values = np.clip(chunk["night"][mask].astype(np.int64) - at // 86400, 0, self.MAX_LEAD_DAYS)
+            elif by == "hour":
+                values = (at + utc_offset) // 3600 % 24
+            else:
+                # 1970-01-01 was a Thursday
+                values = ((at + utc_offset) // 86400 + 3) % 7
+            counts += np.bincount(values, minlength=buckets)
+        return counts
+
+    def report(self, by: str = "hour", camp_id: Optional[int] = None, event: int = OPENED,
+               since: Optional[datetime] = None, width: int = 40) -> str:
+        """ Returns histogram as a text chart. """
+        counts = self.histogram(by, camp_id, event, since)
+        what = "opened" if event == self.OPENED else "taken"
+        of_camp = f" of camp {camp_id}" if camp_id is not None else ""
+        since_str = f" since {since.date()}" if since is not None else ""
+        out = [f"Site nights {what}{of_camp}{since_str} by {by.replace('_', ' ')}, {counts.sum()} in total:"]
+        top = max(1, counts.max())
+        for i, count in enumerate(counts):
+            if by == "lead_days" and not count:
+                continue
+            if by == "weekday":
+                label = self.WEEKDAYS[i]
+            elif by == "lead_days" and i == self.MAX_LEAD_DAYS:
+                label = f"{i}+"
+            else:
+                label = f"{i:02d}"
+            out.append(f"{label:>4} {count:>8} {'#' * int(round(width * count / top))}")
+        return "\n".join(out) + "\n"
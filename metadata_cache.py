@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+class MetadataCache:
+    """
+    Persistent key -> JSON value cache backed by SQLite.
+    Entries expire ttl seconds after they were put, the least recently used ones are evicted
+    once there are more than max_entries of them.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 60 * 60, max_entries: int = 10000):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        expired = self._db.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),)).rowcount
+        self._db.commit()
+        self._logger.info(f"Loaded {len(self)} metadata entries from {path}, dropped {expired} expired")
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, key: str):
+        now = time.time()
+        row = self._db.execute(
+            "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value) -> None:
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + self.ttl, now))
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)", (excess,))
+        self._db.commit()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        return f"metadata cache: {self.hits} hits, {self.misses} misses ({ratio:.0%} hit ratio), {len(self)} entries"
+
+    def close(self) -> None:
+        self._db.close()
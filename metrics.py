@@ -0,0 +1,221 @@
+import bisect
+import contextlib
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Dict[str, object]) -> LabelsKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelsKey, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelsKey, float] = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels_key(labels), 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[_labels_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # labels -> (counts per bucket, the last one is +Inf; sum)
+        self._values: Dict[LabelsKey, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels_key(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        values = self._values.get(_labels_key(labels))
+        return sum(values[0]) if values else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """ Returns the upper bound of the bucket the q quantile falls in. """
+        values = self._values.get(_labels_key(labels))
+        if not values or not sum(values[0]):
+            return None
+        rank = q * sum(values[0])
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), values[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        ret = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(key, 'le="' + le + '"')
+                ret.append(f"{self.name}_bucket{labels} {cumulative}")
+            ret.append(f"{self.name}_sum{_format_labels(key)} {total[0]}")
+            ret.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return ret
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _get(self, cls, name: str, help_text: str, **kwargs):
+        if name not in self._metrics:
+            self._metrics[name] = cls(name, help_text, **kwargs)
+        return self._metrics[name]
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str) -> Gauge:
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name: str, help_text: str, **kwargs) -> Histogram:
+        return self._get(Histogram, name, help_text, **kwargs)
+
+    def render(self) -> str:
+        """ Returns all the metrics in Prometheus text exposition format. """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "campsite_request_seconds", "Latency of requests to recreation.gov by endpoint")
+REQUEST_BYTES = REGISTRY.counter(
+    "campsite_request_bytes_total", "Bytes of request urls sent to recreation.gov by endpoint")
+RESPONSE_BYTES = REGISTRY.counter(
+    "campsite_response_bytes_total", "Bytes of response bodies received from recreation.gov by endpoint")
+RESPONSES = REGISTRY.counter(
+    "campsite_responses_total", "Responses from recreation.gov by endpoint and status code")
+RESPONSE_WIRE_BYTES = REGISTRY.counter(
+    "campsite_response_wire_bytes_total", "Bytes of response bodies as transferred, compressed, by endpoint")
+RESPONSE_BYTES_SAVED = REGISTRY.counter(
+    "campsite_response_bytes_saved_total",
+    "Bytes of responses not transferred thanks to fresh or revalidated (304) cached responses, by endpoint")
+CONNECTIONS = REGISTRY.counter(
+    "campsite_connections_total", "Connections to recreation.gov by result: new (handshake paid) or reused")
+PHASE_SECONDS = REGISTRY.histogram(
+    "campsite_phase_seconds", "Time spent in a phase of a check: merge, evaluate, rates, notify")
+CACHE_REQUESTS = REGISTRY.counter(
+    "campsite_cache_requests_total", "Cache lookups by cache (metadata, in_flight, dns, response, matrix, sites) and result (hit, revalidated or miss)")
+NOTIFICATIONS = REGISTRY.counter(
+    "campsite_notifications_total", "Notification deliveries by sink and result")
+POLLS = REGISTRY.counter(
+    "campsite_polls_total", "Camp months considered by adaptive polling by result: polled, not_due or over_budget")
+WATCHES = REGISTRY.gauge(
+    "campsite_watches", "Watches checked by the crawler")
+SHARD_WORKERS = REGISTRY.counter(
+    "campsite_shard_workers_total", "Shard worker processes by event: started or died")
+CYCLE_SECONDS = REGISTRY.histogram(
+    "campsite_cycle_seconds", "Duration of a crawl_loop cycle")
+LAST_CYCLE_SECONDS = REGISTRY.gauge(
+    "campsite_last_cycle_seconds", "Duration of the last crawl_loop cycle")
+LAST_CYCLE_SAVED_BYTES = REGISTRY.gauge(
+    "campsite_last_cycle_saved_bytes", "Bytes of responses the last crawl_loop cycle did not transfer thanks to the cache")
+CHECK_FREQ_SECONDS = REGISTRY.gauge(
+    "campsite_check_freq_seconds", "Configured time between crawl_loop cycles")
+
+
+def summary() -> str:
+    """ Returns a one line summary of the most interesting metrics. """
+    hits = CACHE_REQUESTS.value(cache="metadata", result="hit")
+    misses = CACHE_REQUESTS.value(cache="metadata", result="miss")
+    lookups = hits + misses
+    p50, p95 = [REQUEST_SECONDS.quantile(q, endpoint="availability") for q in (0.5, 0.95)]
+    reused = CONNECTIONS.value(result="reused")
+    connections = reused + CONNECTIONS.value(result="new")
+    return (f"cycles: {CYCLE_SECONDS.count()}, last cycle: {LAST_CYCLE_SECONDS.value():.3f}s, "
+            f"requests: {REQUEST_SECONDS.count(endpoint='availability')} availability "
+            f"(p50 <= {p50 or 0}s, p95 <= {p95 or 0}s), {REQUEST_SECONDS.count(endpoint='campground')} campground, "
+            f"{REQUEST_SECONDS.count(endpoint='rates')} rates, "
+            f"received: {RESPONSE_BYTES.total() / 1024 / 1024:.1f} MiB "
+            f"({RESPONSE_WIRE_BYTES.total() / 1024 / 1024:.1f} MiB transferred), "
+            f"saved by the response cache: {RESPONSE_BYTES_SAVED.total() / 1024 / 1024:.1f} MiB "
+            f"({LAST_CYCLE_SAVED_BYTES.value() / 1024 / 1024:.1f} MiB in the last cycle), "
+            f"connections reused: {reused / connections if connections else 0:.0%}, "
+            f"metadata cache hit ratio: {hits / lookups if lookups else 0:.0%}")
+
+
+class MetricsServer:
+    """ Serves REGISTRY at http://host:port/metrics for Prometheus. """
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._port = port
+        self._host = host
+        self._runner = None
+
+    async def _metrics(self, request):
+        from aiohttp import web
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self) -> None:
+        # aiohttp.web is slow to import and only needed when metrics are served
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        self._logger.info(f"Serving metrics at http://{self._host}:{self._port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,236 @@
+import abc
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+from typing import List, Optional
+
+import aiohttp
+
+import metrics
+
+
+class Sink(abc.ABC):
+    """
+    Delivers messages somewhere. A message is sent in parts, each part is retried on its own, so a part
+    already delivered is not sent again. Sends of a sink are at least min_interval seconds apart.
+    """
+    min_interval: float = 0
+    retries: int = 3
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def parts(self, message: str) -> List[str]:
+        """ Returns the parts the message is sent in. """
+        return [message]
+
+    @abc.abstractmethod
+    async def send(self, message: str) -> None:
+        """ Sends a part of a message, raises if it was not delivered. """
+
+    async def close(self) -> None:
+        pass
+
+
+class StdoutSink(Sink):
+    async def send(self, message: str) -> None:
+        print(message)
+
+
+class FileSink(Sink):
+    def __init__(self, path: str):
+        super().__init__()
+        self._path = path
+
+    def _write(self, message: str) -> None:
+        with open(self._path, "a") as fh:
+            print(message, file=fh)
+
+    async def send(self, message: str) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._write, message)
+
+
+class TelegramSink(Sink):
+    MAX_MESSAGE_LEN = 4096
+    # Telegram does not like more than a message per second in a chat
+    min_interval = 1
+
+    def __init__(self, token: str, chat_id: str, html: bool):
+        super().__init__()
+        self._config = self._gen_telegram_config(token, chat_id)
+        self._html = html
+
+    def _gen_telegram_config(self, token, chat_id) -> str:
+        self._logger.info("Generating telegram config")
+        tmp_handle, tmp_path = tempfile.mkstemp()
+        with os.fdopen(tmp_handle, 'w') as fh:
+            print(
+                f"[telegram]\ntoken = {token}\nchat_id = {chat_id}\n", file=fh)
+        return tmp_path
+
+    def parts(self, message: str) -> List[str]:
+        if len(message) < self.MAX_MESSAGE_LEN:
+            return [message]
+        lines = message.splitlines()
+        message = ""
+        messages = []
+        for line in lines:
+            if len(message) + len(line) + 2 >= self.MAX_MESSAGE_LEN:
+                messages.append(message)
+                message = ""
+            message += f"\n{line}"
+        messages.append(message)
+        return messages
+
+    def _send(self, message: str) -> None:
+        # Imported on use, it pulls python-telegram-bot in and most runs never notify telegram
+        import telegram_send
+        telegram_send.send(
+            messages=[message],
+            conf=self._config,
+            parse_mode="html" if self._html else "text"
+        )
+
+    async def send(self, message: str) -> None:
+        self._logger.debug("Sending a message to telegram chat")
+        # telegram_send is blocking, keep it off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, self._send, message)
+
+
+class WebhookSink(Sink):
+    """ POSTs {"text": message} as JSON to the url. """
+
+    def __init__(self, url: str, timeout: float = 30):
+        super().__init__()
+        self._url = url
+        self._timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def send(self, message: str) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self._timeout))
+        async with self._session.post(self._url, json={"text": message}) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"Webhook {self._url} answered {resp.status}: {await resp.text()}")
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class _SinkWorker:
+    """ Feeds a sink from its own queue, so a slow or failing sink does not hold others. """
+
+    def __init__(self, sink: Sink):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.sink = sink
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._last_sent = 0.0
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            for part in self.sink.parts(message):
+                await self._deliver(part)
+
+    async def _deliver(self, message: str) -> None:
+        sink_name = self.sink.__class__.__name__
+        for attempt in range(self.sink.retries + 1):
+            wait = self._last_sent + self.sink.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last_sent = time.monotonic()
+            try:
+                with metrics.PHASE_SECONDS.time(phase="notify"):
+                    await self.sink.send(message)
+                metrics.NOTIFICATIONS.inc(sink=sink_name, result="sent")
+                return
+            except Exception as e:
+                metrics.NOTIFICATIONS.inc(sink=sink_name, result="failed")
+                if attempt == self.sink.retries:
+                    self._logger.error(f"Giving up on sending a message with {sink_name}: {e}")
+                    return
+                delay = random.uniform(0, 2 ** attempt)
+                self._logger.warning(f"Could not send a message with {sink_name}, retrying in {delay:.2f} seconds: {e}")
+                await asyncio.sleep(delay)
+
+
+class NotificationQueue:
+    """
+    Takes messages without waiting for the delivery. Messages put within batch_window seconds
+    of each other are joined into one and sent to every sink.
+    """
+
+    def __init__(self, sinks: List[Sink], batch_window: float = 2):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._sinks = sinks
+        self._batch_window = batch_window
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._workers: List[_SinkWorker] = []
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._workers = [_SinkWorker(sink) for sink in self._sinks]
+        self._task = asyncio.ensure_future(self._run())
+
+    def put(self, message: str) -> None:
+        if self._queue is None:
+            raise RuntimeError("Notification queue is not started")
+        self._queue.put_nowait(message)
+
+    async def close(self) -> None:
+        """ Delivers everything queued so far and stops the workers. """
+        if self._queue is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        for worker in self._workers:
+            worker.queue.put_nowait(None)
+        await asyncio.gather(*[worker.task for worker in self._workers])
+        await asyncio.gather(*[sink.close() for sink in self._sinks])
+        self._queue = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        closing = False
+        while not closing:
+            message = await self._queue.get()
+            if message is None:
+                return
+            batch = [message]
+            deadline = loop.time() + self._batch_window
+            while True:
+                try:
+                    message = await asyncio.wait_for(self._queue.get(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if message is None:
+                    closing = True
+                    break
+                batch.append(message)
+            if len(batch) > 1:
+                self._logger.debug(f"Batched {len(batch)} messages")
+            for worker in self._workers:
+                worker.queue.put_nowait("\n".join(batch))
+
+
+def make_sinks(telegram_token: Optional[str] = None, telegram_chat_id: Optional[str] = None, html: bool = False,
+               webhook_url: Optional[str] = None, notify_file: Optional[str] = None) -> List[Sink]:
+    """ Returns sinks of the given targets, StdoutSink if there are none. """
+    sinks: List[Sink] = []
+    if telegram_token and telegram_chat_id:
+        sinks.append(TelegramSink(telegram_token, telegram_chat_id, html))
+    if webhook_url:
+        sinks.append(WebhookSink(webhook_url))
+    if notify_file:
+        sinks.append(FileSink(notify_file))
+    return sinks or [StdoutSink()]
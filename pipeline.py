@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List
+
+
+class CampPipeline:
+    """
+    Fetch -> evaluate stages of a check, camp by camp: a camp is handed to consume as soon as all its
+    months arrived instead of after the months of all the camps, and camps are consumed concurrently
+    so one waiting for its rates does not hold back the others.
+    At most max_in_flight camps are fetched or consumed at a time, the next camp is not started before
+    one of them is done, so memory of a check does not grow with the number of camps.
+    Camp starts are evenly spread over spread_over seconds.
+    """
+
+    def __init__(self, max_in_flight: int = 32):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.max_in_flight = max(1, max_in_flight)
+
+    async def run(self, camps: Dict[Hashable, List], fetch: Callable[[Hashable, List], Awaitable],
+                  consume: Callable[[Hashable, object], Awaitable], spread_over: float = 0) -> None:
+        """
+        Calls fetch(camp_id, months) for every camp of camps and consume(camp_id, what fetch returned).
+        Raises the first exception of fetch or consume, the camps in flight are cancelled then.
+        """
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        step = spread_over / len(camps) if camps else 0
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks: List[asyncio.Future] = []
+
+        async def process(camp_id, months, delay):
+            try:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await consume(camp_id, await fetch(camp_id, months))
+            finally:
+                slots.release()
+
+        try:
+            for i, camp_id in enumerate(sorted(camps)):
+                await slots.acquire()
+                failed = [x for x in tasks if x.done() and not x.cancelled() and x.exception() is not None]
+                if failed:
+                    raise failed[0].exception()
+                delay = started_at + i * step - loop.time()
+                tasks.append(asyncio.ensure_future(process(camp_id, camps[camp_id], delay)))
+                # Forgets the camps done, so there are never much more than max_in_flight of them
+                tasks = [x for x in tasks if not x.done() or (not x.cancelled() and x.exception() is not None)]
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,120 @@
+import collections
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import metrics
+
+PollKey = Tuple[Hashable, datetime]
+
+
+class _PollState:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.polled_at: Optional[float] = None
+        self.payload = None
+        self.changes = 0
+        self.polls = 0
+
+
+class PollScheduler:
+    """
+    Decides which (camp_id, month) to fetch in a cycle instead of fetching all of them.
+    Every month has its own interval between polls within min_interval..max_interval: it is halved when
+    the month changed since the previous poll and grows by GROWTH when it did not. Months closer than
+    HORIZON_DAYS are also capped proportionally to how close they are, so the next weeks stay at
+    min_interval even when they rarely change.
+    At most budget_per_minute polls are done in any 60 seconds (0 is no limit), the most overdue months
+    go first. Months never fetched are always fetched, there is nothing to check without them.
+    Months not asked for during two max_interval are forgotten.
+    """
+    GROWTH = 1.5
+    HORIZON_DAYS = 90
+    BUDGET_WINDOW = 60
+
+    def __init__(self, min_interval: float, max_interval: float, budget_per_minute: int = 0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.budget_per_minute = budget_per_minute
+        self._states: Dict[PollKey, _PollState] = {}
+        self._polls = collections.deque()
+
+    def _cap(self, month: datetime, today: Optional[datetime] = None) -> float:
+        days_away = max(0, (month - (today or datetime.now())).days)
+        share = min(1.0, days_away / self.HORIZON_DAYS)
+        return self.min_interval + (self.max_interval - self.min_interval) * share
+
+    def due(self, keys: Iterable[PollKey], now: Optional[float] = None) -> Set[PollKey]:
+        """ Returns the keys to poll now. """
+        now = time.monotonic() if now is None else now
+        while self._polls and self._polls[0] <= now - self.BUDGET_WINDOW:
+            self._polls.popleft()
+        keys = set(keys)
+        for key in set(self._states) - keys:
+            # Not asked for in a while, e.g. a request is in the past
+            state = self._states[key]
+            if state.polled_at is None or now - state.polled_at > 2 * self.max_interval:
+                del self._states[key]
+        required: List[PollKey] = []
+        overdue: List[Tuple[float, PollKey]] = []
+        for key in keys:
+            state = self._states.setdefault(key, _PollState(self.min_interval))
+            if state.payload is None:
+                required.append(key)
+                continue
+            # A poll a bit early is better than one a whole cycle late
+            ratio = (now - state.polled_at) / state.interval
+            if ratio >= 0.95:
+                overdue.append((ratio, key))
+        overdue.sort(key=lambda x: (-x[0], x[1]))
+        allowed = len(overdue)
+        if self.budget_per_minute:
+            allowed = max(0, min(allowed, self.budget_per_minute - len(self._polls) - len(required)))
+        ret = set(required) | {key for _, key in overdue[:allowed]}
+        metrics.POLLS.inc(len(ret), result="polled")
+        metrics.POLLS.inc(len(keys) - len(required) - len(overdue), result="not_due")
+        metrics.POLLS.inc(len(overdue) - allowed, result="over_budget")
+        if len(overdue) > allowed:
+            self._logger.warning(f"Poll budget of {self.budget_per_minute}/min is used up, "
+                                 f"postponing {len(overdue) - allowed} overdue camp month(s)")
+        self._polls.extend([now] * len(ret))
+        return ret
+
+    def record(self, key: PollKey, payload, now: Optional[float] = None, today: Optional[datetime] = None) -> bool:
+        """
+        Takes the fetched payload of the key into account, returns True if it changed.
+        The month is capped by how far it is from today, the current time by default.
+        """
+        now = time.monotonic() if now is None else now
+        state = self._states.setdefault(key, _PollState(self.min_interval))
+        changed = state.payload is not None and state.payload is not payload and state.payload != payload
+        state.polls += 1
+        if changed:
+            state.changes += 1
+            interval = state.interval / 2
+        elif state.payload is None:
+            interval = state.interval
+        else:
+            interval = state.interval * self.GROWTH
+        state.interval = max(self.min_interval, min(interval, self._cap(key[1], today)))
+        state.polled_at = now
+        state.payload = payload
+        return changed
+
+    def payload(self, key: PollKey):
+        """ Returns the last fetched payload of the key. """
+        state = self._states.get(key)
+        return state.payload if state is not None else None
+
+    def stats(self) -> str:
+        if not self._states:
+            return "no camp months polled"
+        intervals = sorted(x.interval for x in self._states.values())
+        polls = sum(x.polls for x in self._states.values())
+        changes = sum(x.changes for x in self._states.values())
+        return (f"{len(self._states)} camp months, poll interval min {intervals[0]:.0f}s, "
+                f"median {intervals[len(intervals) // 2]:.0f}s, max {intervals[-1]:.0f}s, "
+                f"{changes / polls if polls else 0:.0%} of polls found changes, "
+                f"{len(self._polls)} polls in the last minute")
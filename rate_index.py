@@ -0,0 +1,72 @@
+import bisect
+import logging
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import date_helper
+
+NO_RATE = (0, "NaN")
+
+
+class RateIndex:
+    """
+    Rates payload of a campground compiled once for lookups: seasons sorted by their start
+    for bisect, and a campsite_type -> rate_map entry dict per season.
+    Lookups are memoized, so all the sites of the same type and dates cost one dict access.
+    """
+
+    def __init__(self, rates: dict):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        seasons = []
+        for order, r in enumerate(rates['rates_list']):
+            # The first season of the list wins when several contain the dates, keep the order
+            seasons.append((date_helper.date_from_str(r['season_start']),
+                            date_helper.date_from_str(r['season_end']), order, r))
+        seasons.sort(key=lambda x: (x[0], x[2]))
+        self._starts = [x[0] for x in seasons]
+        self._seasons = seasons
+        self._type_rates: Dict[int, Dict[str, dict]] = {}
+        for _, _, order, r in seasons:
+            type_rates = {}
+            for key, campsite_type in r["site_type_map"].items():
+                if campsite_type not in type_rates:
+                    type_rates[campsite_type] = r["rate_map"][key]
+            self._type_rates[order] = type_rates
+        self._lookups: Dict[Tuple[str, datetime, datetime], Tuple[float, str]] = {}
+
+    def _season(self, start_date: datetime, end_date: datetime) -> Optional[int]:
+        """ Returns the order of the season containing start_date..end_date. """
+        candidates = self._seasons[:bisect.bisect_right(self._starts, start_date)]
+        orders = [order for _, season_end, order, _ in candidates if end_date <= season_end]
+        return min(orders) if orders else None
+
+    def lookup(self, campsite_type: str, start_date: datetime, end_date: datetime) -> Tuple[float, str]:
+        """ Returns (rate, human readable rate) of the campsite type for the dates. """
+        key = (campsite_type, start_date, end_date)
+        if key not in self._lookups:
+            self._lookups[key] = self._lookup(campsite_type, start_date, end_date)
+        return self._lookups[key]
+
+    def _lookup(self, campsite_type: str, start_date: datetime, end_date: datetime) -> Tuple[float, str]:
+        season = self._season(start_date, end_date)
+        if season is None:
+            self._logger.warning("Could not find rate")
+            return NO_RATE
+        s = self._type_rates[season].get(campsite_type)
+        if s is None:
+            self._logger.warning("Could not find rate key")
+            return NO_RATE
+
+        ret = NO_RATE
+        # There are more values, never seen them non 0/none for what I'm looking for
+        if s["per_night"]:
+            ret = (s["per_night"], f"${s['per_night']}/night")
+        elif s["per_person"]:
+            ret = (s["per_person"], f"${s['per_person']}/person")
+        elif s["group_fees"]:
+            k = list(s["group_fees"].keys())[0]
+            v = s["group_fees"][k]
+            ret = (v, f"${v}/group {k}")
+        if not ret[0]:
+            self._logger.warning("Could not find rate")
+        return ret
@@ -0,0 +1,98 @@
+import asyncio
+import contextlib
+import logging
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """ Allows `rate` acquisitions per second with bursts up to `capacity`. """
+
+    def __init__(self, rate: float, capacity: float = 0):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def slow_down(self, pause: float, min_rate: float) -> None:
+        """ Halves the rate and stops handing out tokens for `pause` seconds. """
+        self.rate = max(min_rate, self.rate / 2)
+        self._tokens = 0
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def speed_up(self, step: float) -> None:
+        """ Slowly gets the rate back to the configured one after a slow_down. """
+        self.rate = min(self.max_rate, self.rate + step)
+
+
+class RequestScheduler:
+    """
+    Limits the number of requests in flight and the requests per second per host.
+    Hosts answering 429/503 get their rate halved and paused, the rate recovers on successes.
+    """
+    THROTTLE_STATUSES = (429, 503)
+    MIN_RPS = 0.2
+    RECOVER_STEP = 0.1
+    DEFAULT_PAUSE = 5
+
+    def __init__(self, max_concurrency: int, max_rps: float):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.max_concurrency = max_concurrency
+        self.max_rps = max_rps
+        self._semaphore = None
+        self._buckets = {}
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so the semaphore belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.max_rps)
+        return self._buckets[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url: str):
+        queued_at = time.monotonic()
+        async with self._get_semaphore():
+            if self.max_rps > 0:
+                await self._bucket(url).take()
+            self._logger.debug(
+                f"Request to {url} waited {time.monotonic() - queued_at:.3f} seconds in queue")
+            yield
+
+    def on_response(self, url: str, status: int, retry_after=None) -> None:
+        if self.max_rps <= 0:
+            return
+        bucket = self._bucket(url)
+        if status in self.THROTTLE_STATUSES:
+            try:
+                pause = float(retry_after)
+            except (TypeError, ValueError):
+                pause = self.DEFAULT_PAUSE
+            bucket.slow_down(pause, self.MIN_RPS)
+            self._logger.warning(
+                f"Got {status} from {url}, slowing down to {bucket.rate:.2f} requests/sec for {pause} seconds")
+        else:
+            bucket.speed_up(self.RECOVER_STEP)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+ArchiveKey = Tuple[str, str]
+
+
+class ResponseArchive:
+    """
+    Raw bodies of recreation.gov responses in an SQLite file, indexed by url path, params and the time
+    they were received. Bodies are stored once per content, zlib compressed, so the months that do not
+    change between checks cost a row of the index only.
+    When recording every response Connection.send_request returns is appended, also the ones answered
+    by the response cache. When replaying the archive is played cycle by cycle on its recorded clock: tick()
+    moves the clock to the time of the first response not replayed yet, and a url and params get their first
+    response recorded at or after it, so the ones skipped by a check are not served late; the last one once
+    they are used up. An unchanged body is the very same object as the previous time, like with the response
+    cache. Requests that were not recorded fail.
+    """
+    COMMIT_EVERY = 100
+
+    def __init__(self, path: str, replaying: bool = False):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.replaying = replaying
+        if replaying and not os.path.exists(path):
+            raise ValueError(f"There is no archive {path} to replay")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, body BLOB NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (id INTEGER PRIMARY KEY, url TEXT NOT NULL, params TEXT NOT NULL, "
+            "received_at REAL NOT NULL, hash TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_key ON responses (url, params, received_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_received_at ON responses (received_at)")
+        self._db.commit()
+        self._uncommitted = 0
+        # Recording: hash of the last body of a key, replaying: its recorded hashes and the next one to serve
+        self._last_hash: Dict[ArchiveKey, str] = {}
+        self._sequences: Dict[ArchiveKey, List[Tuple[str, float]]] = {}
+        self._positions: Dict[ArchiveKey, int] = {}
+        self._values: Dict[ArchiveKey, Tuple[str, object]] = {}
+        # Replaying: the recorded time of the current cycle and of the last response replayed
+        self.clock: Optional[float] = None
+        self._replayed_until = float("-inf")
+        self.recorded = 0
+        self.replayed = 0
+
+    @staticmethod
+    def _key(url: str, params: dict) -> ArchiveKey:
+        return url, json.dumps(params, sort_keys=True, default=str)
+
+    def record(self, url: str, params: dict, body: bytes) -> None:
+        """ Appends a response received now. """
+        key = self._key(url, params)
+        digest = hashlib.sha1(body).hexdigest()
+        if self._last_hash.get(key) != digest:
+            self._db.execute("INSERT OR IGNORE INTO bodies (hash, body) VALUES (?, ?)", (digest, zlib.compress(body)))
+        self._append(key, digest)
+
+    def record_unchanged(self, url: str, params: dict) -> None:
+        """ Appends a response that is the same as the previous one of the url and params, if it was recorded. """
+        key = self._key(url, params)
+        if key in self._last_hash:
+            self._append(key, self._last_hash[key])
+
+    def _append(self, key: ArchiveKey, digest: str) -> None:
+        self._db.execute("INSERT INTO responses (url, params, received_at, hash) VALUES (?, ?, ?, ?)",
+                         (key[0], key[1], time.time(), digest))
+        self._last_hash[key] = digest
+        self.recorded += 1
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def tick(self) -> Optional[float]:
+        """
+        Moves the clock to the recorded time of the next cycle, the first response recorded after the ones
+        replayed so far, and returns it. Returns None and keeps the clock when all of them are replayed.
+        """
+        at = self._db.execute("SELECT MIN(received_at) FROM responses WHERE received_at > ?",
+                              (self._replayed_until,)).fetchone()[0]
+        if at is not None:
+            self.clock = at
+        return at
+
+    def replay(self, url: str, params: dict):
+        """ Returns the response of the url and params for the current cycle, decoded. """
+        key = self._key(url, params)
+        if key not in self._sequences:
+            self._sequences[key] = list(self._db.execute(
+                "SELECT hash, received_at FROM responses WHERE url = ? AND params = ? ORDER BY received_at, id", key))
+            self._positions[key] = 0
+        sequence = self._sequences[key]
+        if not sequence:
+            raise RuntimeError("failedRequest", f"ERROR, no recorded response for {url} {params} in {self.path}")
+        position = self._positions[key]
+        # Responses of the cycles this one was not asked for are passed over
+        while self.clock is not None and position < len(sequence) - 1 and sequence[position][1] < self.clock:
+            position += 1
+        digest, received_at = sequence[min(position, len(sequence) - 1)]
+        self._positions[key] = position + 1
+        self._replayed_until = max(self._replayed_until, received_at)
+        self.replayed += 1
+        last = self._values.get(key)
+        if last is not None and last[0] == digest:
+            return last[1]
+        body = self._db.execute("SELECT body FROM bodies WHERE hash = ?", (digest,)).fetchone()[0]
+        value = json_loads(zlib.decompress(body))
+        self._values[key] = (digest, value)
+        return value
+
+    def remaining(self) -> int:
+        """ Returns the number of responses recorded after the last one replayed. """
+        return self._db.execute("SELECT COUNT(*) FROM responses WHERE received_at > ?",
+                                (self._replayed_until,)).fetchone()[0]
+
+    def stats(self) -> str:
+        responses, keys = self._db.execute("SELECT COUNT(*), COUNT(DISTINCT url || params) FROM responses").fetchone()
+        bodies, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM bodies").fetchone()
+        ret = (f"Archive {self.path}: {responses} responses of {keys} urls, {bodies} distinct bodies, "
+               f"{size / 2 ** 20:.1f} MiB compressed")
+        if self.replaying:
+            return ret + f", {self.replayed} replayed"
+        return ret + f", {self.recorded} recorded now"
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
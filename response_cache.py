@@ -0,0 +1,87 @@
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Hashable, Mapping, Optional
+
+
+class CachedResponse:
+    """ Decoded body of a response with what is needed to revalidate it. """
+
+    def __init__(self, value, size: int, etag: Optional[str], last_modified: Optional[str], expires_at: float):
+        self.value = value
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() < self.expires_at
+
+    def validators(self) -> dict:
+        """ Returns the headers of a conditional request for the response. """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Keeps the decoded bodies of responses that came with ETag, Last-Modified or Cache-Control max-age.
+    Fresh responses are served without a request, stale ones are revalidated with a conditional request
+    and a 304 answer reuses the decoded body. The least recently used responses are dropped once there
+    are more than max_entries of them.
+    """
+    MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+    def __init__(self, max_entries: int = 5000):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    @classmethod
+    def _max_age(cls, headers: Mapping[str, str]) -> Optional[float]:
+        """ Returns how many more seconds the response is fresh for, None if the server did not tell. """
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-cache" in cache_control:
+            return 0
+        match = cls.MAX_AGE_RE.search(cache_control)
+        if match is None:
+            return None
+        age = headers.get("Age", "0")
+        return max(0, int(match.group(1)) - (int(age) if age.isdigit() else 0))
+
+    def put(self, key: Hashable, value, size: int, headers: Mapping[str, str]) -> None:
+        """ Stores the decoded response if its headers allow to reuse it. """
+        if "no-store" in headers.get("Cache-Control", "").lower():
+            self._entries.pop(key, None)
+            return
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        max_age = self._max_age(headers)
+        if not etag and not last_modified and not max_age:
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = CachedResponse(value, size, etag, last_modified, time.monotonic() + (max_age or 0))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def revalidated(self, entry: CachedResponse, headers: Mapping[str, str]) -> CachedResponse:
+        """ Updates the entry after a 304 answer, returns it. """
+        entry.etag = headers.get("ETag", entry.etag)
+        entry.last_modified = headers.get("Last-Modified", entry.last_modified)
+        entry.expires_at = time.monotonic() + (self._max_age(headers) or 0)
+        return entry
@@ -0,0 +1,282 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import pickle
+import signal
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from availability_matrix import AvailabilityMatrix
+from connection import Connection
+from metadata_cache import MetadataCache
+import metrics
+from user_request import UserRequest
+
+# (watch id, index of the request in the watch)
+JobId = Tuple[str, int]
+
+
+class HashRing:
+    """
+    Consistent hashing of camp ids to nodes: every node owns `replicas` points of the ring and a camp
+    goes to the node of the first point after its hash. Removing a node moves only the camps it owned.
+    """
+
+    def __init__(self, nodes: Tuple[str, ...] = (), replicas: int = 64):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._nodes: Dict[int, str] = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def __len__(self) -> int:
+        return len(set(self._nodes.values()))
+
+    def __contains__(self, node: str) -> bool:
+        return node in self._nodes.values()
+
+    def add(self, node: str) -> None:
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+                self._nodes[point] = node
+
+    def remove(self, node: str) -> None:
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._points.remove(point)
+
+    def node_for(self, key: Hashable) -> str:
+        if not self._points:
+            raise RuntimeError("There are no nodes in the ring")
+        i = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._nodes[self._points[i]]
+
+
+class WorkerDied(Exception):
+    pass
+
+
+def _portable(error: Exception) -> Exception:
+    """ Returns the error if it survives pickling, a RuntimeError with its text otherwise. """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{error.__class__.__name__}: {error}")
+
+
+class _ShardWorker:
+    """ Fetch and evaluate path of a worker process, its caches live as long as the process. """
+
+    def __init__(self, settings: dict):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        Connection.BASE_URL = settings["base_url"]
+        Connection.configure_scheduler(settings["max_concurrency"], settings["max_rps"])
+        Connection.configure_retries(settings["request_timeout"], settings["retries"])
+        Connection.configure_session(settings["connection_limit"], settings["connection_limit_per_host"],
+                                     settings["dns_cache_ttl"], settings["keepalive_timeout"], settings["compress"])
+        Connection.configure_response_cache(settings["response_cache_size"])
+        self._metadata_cache: Optional[MetadataCache] = None
+        if settings["metadata_cache"]:
+            self._metadata_cache = MetadataCache(
+                settings["metadata_cache"], settings["metadata_cache_ttl"], settings["metadata_cache_size"])
+        Connection.configure_metadata_cache(self._metadata_cache)
+        self._matrices: Dict[int, Tuple[List[dict], AvailabilityMatrix]] = {}
+
+    async def evaluate(self, jobs: List[Tuple[JobId, dict]], tolerate_failures: bool,
+                       spread_over: float) -> Dict[JobId, Dict[int, object]]:
+        """ Returns UserRequest.evaluate results of the jobs, the months they need are fetched once. """
+        requests = {job_id: UserRequest.make_user_requests(**spec)[0] for job_id, spec in jobs}
+        plan = set()
+        for user_request in requests.values():
+            plan |= user_request.fetch_plan()
+        months_info = await Connection.get_planned_months(
+            plan, return_exceptions=tolerate_failures, spread_over=spread_over)
+        with metrics.PHASE_SECONDS.time(phase="merge"):
+            matrices = AvailabilityMatrix.by_camp(months_info, self._matrices)
+        ret = {}
+        for job_id, user_request in requests.items():
+            results = await user_request.evaluate(matrices)
+            ret[job_id] = {k: _portable(v) if isinstance(v, Exception) else v for k, v in results.items()}
+        UserRequest.SITES.retain(x for user_request in requests.values() for x in user_request.site_dates())
+        return ret
+
+    async def start(self) -> None:
+        Connection.open_session()
+
+    async def close(self) -> None:
+        await Connection.close_session()
+        if self._metadata_cache is not None:
+            self._metadata_cache.close()
+
+
+def _worker_main(conn, name: str, settings: dict) -> None:
+    """ Entry point of a worker process: answers ("evaluate", ...) messages until ("stop",) or EOF. """
+    logging.basicConfig(level=settings["log_level"], format=f"%(asctime)s {name} %(name)s %(levelname)s %(message)s")
+    # Ctrl-C is handled by the coordinator, it stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = _ShardWorker(settings)
+    loop.run_until_complete(worker.start())
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == "stop":
+                break
+            try:
+                reply = ("ok", loop.run_until_complete(worker.evaluate(*message[1:])))
+            except Exception as e:
+                reply = ("error", _portable(e))
+            conn.send(reply)
+    finally:
+        loop.run_until_complete(worker.close())
+        loop.close()
+
+
+class ShardPool:
+    """
+    Worker processes on this box, camps are spread over them with HashRing so a camp is fetched
+    and evaluated by the same worker every cycle and its caches stay warm there.
+    A worker that dies or does not answer within timeout is taken out of the ring and its camps are
+    redone by the others in the same cycle, a replacement is started and joins the ring the next cycle.
+    Workers share max_rps and max_concurrency evenly.
+    """
+    RESTART_DELAY = 5
+
+    def __init__(self, workers: int, settings: dict, timeout: float = 10 * 60):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.size = workers
+        self._settings = dict(settings)
+        self._settings["max_rps"] = settings["max_rps"] / workers
+        self._settings["max_concurrency"] = max(1, settings["max_concurrency"] // workers)
+        self._timeout = timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._ring = HashRing()
+        self._processes: Dict[str, Tuple[multiprocessing.Process, object]] = {}
+        self._restart_at: Dict[str, float] = {}
+
+    @property
+    def workers(self) -> List[str]:
+        return sorted(self._processes)
+
+    def _spawn(self, name: str) -> None:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn, name, self._settings), name=name, daemon=True)
+        process.start()
+        child_conn.close()
+        self._processes[name] = (process, parent_conn)
+        self._ring.add(name)
+        metrics.SHARD_WORKERS.inc(event="started")
+        self._logger.info(f"Started {name} (pid {process.pid})")
+
+    def start(self) -> None:
+        for i in range(self.size):
+            self._spawn(f"worker-{i}")
+
+    def _call(self, name: str, message: tuple, timeout: float):
+        """ Sends the message to the worker and waits for the reply, blocking. """
+        process, conn = self._processes[name]
+        try:
+            conn.send(message)
+            while not conn.poll(1):
+                timeout -= 1
+                if not process.is_alive() or timeout <= 0:
+                    raise WorkerDied(f"{name} is dead" if not process.is_alive() else f"{name} does not answer")
+            return conn.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerDied(f"{name} is gone: {e}")
+
+    def _retire(self, name: str) -> None:
+        """ Takes the worker out of the ring and kills it, a replacement is started by the next cycle. """
+        self._ring.remove(name)
+        process, conn = self._processes.pop(name)
+        conn.close()
+        if process.is_alive():
+            process.kill()
+        process.join(1)
+        self._restart_at[name] = asyncio.get_event_loop().time() + self.RESTART_DELAY
+
+    def _restart_retired(self) -> None:
+        now = asyncio.get_event_loop().time()
+        for name, at in list(self._restart_at.items()):
+            if at <= now:
+                del self._restart_at[name]
+                self._spawn(name)
+
+    def partition(self, camp_ids: List[int]) -> Dict[str, List[int]]:
+        """ Returns worker name -> camps of camp_ids it is responsible for. """
+        ret: Dict[str, List[int]] = {}
+        for camp_id in camp_ids:
+            ret.setdefault(self._ring.node_for(camp_id), []).append(camp_id)
+        return ret
+
+    async def evaluate(self, jobs: List[Tuple[JobId, UserRequest]], tolerate_failures: bool = False,
+                       spread_over: float = 0) -> Dict[JobId, Dict[int, object]]:
+        """
+        Returns UserRequest.evaluate results of the jobs, every job is split across the workers by its camps.
+        Raises what a worker failed with unless the worker died, then its camps are given to the others.
+        """
+        self._restart_retired()
+        ret: Dict[JobId, Dict[int, object]] = {job_id: {} for job_id, _ in jobs}
+        pending = [(job_id, user_request, user_request.camp_ids) for job_id, user_request in jobs]
+        while pending:
+            if not len(self._ring):
+                raise WorkerDied("All the workers are dead")
+            shards: Dict[str, List[Tuple[JobId, UserRequest, List[int]]]] = {}
+            for job_id, user_request, camp_ids in pending:
+                for name, shard_camp_ids in self.partition(camp_ids).items():
+                    shards.setdefault(name, []).append((job_id, user_request, shard_camp_ids))
+            loop = asyncio.get_event_loop()
+            names = list(shards)
+            replies = await asyncio.gather(*[
+                loop.run_in_executor(None, self._call, name, (
+                    "evaluate", [(job_id, x.for_camps(camp_ids)) for job_id, x, camp_ids in shards[name]],
+                    tolerate_failures, spread_over), self._timeout + spread_over)
+                for name in names
+            ], return_exceptions=True)
+            pending = []
+            for name, reply in zip(names, replies):
+                if isinstance(reply, WorkerDied):
+                    self._logger.warning(f"{reply}, moving its {len(shards[name])} job part(s) to the other workers")
+                    metrics.SHARD_WORKERS.inc(event="died")
+                    self._retire(name)
+                    pending.extend(shards[name])
+                    continue
+                if isinstance(reply, Exception):
+                    raise reply
+                status, payload = reply
+                if status == "error":
+                    raise payload
+                for job_id, results in payload.items():
+                    ret[job_id].update(results)
+        return ret
+
+    async def close(self) -> None:
+        for name, (process, conn) in self._processes.items():
+            try:
+                conn.send(("stop",))
+            except OSError:
+                pass
+        loop = asyncio.get_event_loop()
+        for name, (process, conn) in self._processes.items():
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                self._logger.warning(f"{name} did not stop, killing it")
+                process.kill()
+            conn.close()
+        self._processes.clear()
+        self._restart_at.clear()
@@ -0,0 +1,117 @@
+import logging
+import sys
+from datetime import datetime as dt
+from typing import Dict, Iterable, List, Set, Tuple
+
+import metrics
+from connection import Connection
+from rate_index import RateIndex
+
+# (start_date, end_date) of a request
+Dates = Tuple[dt, dt]
+
+
+class CampsiteInfo:
+    """
+    Metadata and rate of a campsite for the dates of a request. Slotted, and the strings repeated across
+    sites (loop, site, campsite_type, capacity_rating) are interned, instances are kept by SiteRegistry.
+    """
+    __slots__ = ("campsite_id", "capacity_rating", "min_num_people", "max_num_people", "loop", "site",
+                 "campsite_type", "rate", "rate_str")
+
+    def __init__(self, campsite_id, capacity_rating, min_num_people, max_num_people, loop, site, campsite_type,
+                 rate, rate_str):
+        self.campsite_id = campsite_id
+        self.capacity_rating = _intern(capacity_rating)
+        self.min_num_people = min_num_people
+        self.max_num_people = max_num_people
+        self.loop = _intern(loop)
+        self.site = _intern(site)
+        self.campsite_type = _intern(campsite_type)
+        self.rate = rate
+        self.rate_str = rate_str
+
+    @classmethod
+    def from_site(cls, site: dict, rate_index: RateIndex, start_date: dt, end_date: dt) -> "CampsiteInfo":
+        rate, rate_str = rate_index.lookup(site["campsite_type"], start_date, end_date)
+        return cls(
+            site["campsite_id"],
+            site["capacity_rating"],
+            site["min_num_people"],
+            site["max_num_people"],
+            site["loop"],
+            site["site"],
+            site["campsite_type"],
+            rate,
+            rate_str
+        )
+
+    def __str__(self):
+        return f"  - \"{self.loop}\" - {self.site}, {self.capacity_rating} {self.min_num_people}-{self.max_num_people} ppl, {self.rate_str}"
+
+    def html(self):
+        url = Connection.campsite_url(self.campsite_id)
+        return f"  - <a href=\"{url}\">\"{self.loop}\" - {self.site}</a>, {self.capacity_rating} {self.min_num_people}-{self.max_num_people} ppl, {self.rate_str}"
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class SiteRegistry:
+    """
+    CampsiteInfo of the sites of every camp kept across checks, a site is built once for the dates of
+    a request and rebuilt only when its metadata or the rates of the camp change. Availability is not
+    part of it, that is the AvailabilityMatrix, so a new month response costs a comparison of a few
+    fields per available site instead of a new object and a rate lookup.
+    """
+    # The fields of a site dict CampsiteInfo is made of, besides campsite_id and the rate
+    FIELDS = ("capacity_rating", "min_num_people", "max_num_people", "loop", "site", "campsite_type")
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        # camp_id -> (start_date, end_date) -> (rate index, campsite_id -> (FIELDS of the site it was built from,
+        # CampsiteInfo)), the fields and not the site dict so the registry does not keep response payloads alive
+        self._camps: Dict[int, Dict[Dates, Tuple[RateIndex, Dict[str, Tuple[tuple, CampsiteInfo]]]]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(sites) for camp in self._camps.values() for _, sites in camp.values())
+
+    def infos(self, camp_id: int, sites: List[dict], rate_index: RateIndex, start_date: dt,
+              end_date: dt) -> List[CampsiteInfo]:
+        """ Returns CampsiteInfo of the site dicts of the camp for the dates. """
+        camp = self._camps.setdefault(camp_id, {})
+        dates = (start_date, end_date)
+        if dates not in camp or camp[dates][0] is not rate_index:
+            camp[dates] = (rate_index, {})
+        known = camp[dates][1]
+        ret = []
+        hits = 0
+        for site in sites:
+            fields = tuple(site[x] for x in self.FIELDS)
+            entry = known.get(site["campsite_id"])
+            if entry is not None and entry[0] == fields:
+                info = entry[1]
+                hits += 1
+            else:
+                info = CampsiteInfo.from_site(site, rate_index, start_date, end_date)
+                # Interned like the CampsiteInfo ones, the strings of the payload are not kept either
+                known[site["campsite_id"]] = (tuple(_intern(x) for x in fields), info)
+            ret.append(info)
+        if hits:
+            metrics.CACHE_REQUESTS.inc(hits, cache="sites", result="hit")
+        if len(sites) > hits:
+            metrics.CACHE_REQUESTS.inc(len(sites) - hits, cache="sites", result="miss")
+        return ret
+
+    def retain(self, dates: Iterable[Tuple[int, dt, dt]]) -> None:
+        """ Drops the sites of camps and dates not in dates, (camp_id, start_date, end_date) of the requests. """
+        keep: Dict[int, Set[Dates]] = {}
+        for camp_id, start_date, end_date in dates:
+            keep.setdefault(camp_id, set()).add((start_date, end_date))
+        for camp_id in list(self._camps):
+            camp = self._camps[camp_id]
+            for x in [x for x in camp if x not in keep.get(camp_id, ())]:
+                del camp[x]
+            if not camp:
+                del self._camps[camp_id]
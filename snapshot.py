@@ -0,0 +1,28 @@
+from typing import Collection, Dict, FrozenSet, Hashable, Iterable, Tuple
+
+
+class SnapshotStore:
+    """ Keeps the last seen available campsite ids per key and tells what changed since then. """
+
+    def __init__(self):
+        self._snapshots: Dict[Hashable, FrozenSet[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def update(self, key: Hashable, available: Iterable[str]) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """ Stores the new snapshot for the key, returns (newly available, no longer available) ids. """
+        current = frozenset(available)
+        previous = self._snapshots.get(key, frozenset())
+        self._snapshots[key] = current
+        if current == previous:
+            return frozenset(), frozenset()
+        return current - previous, previous - current
+
+    def forget(self, key: Hashable) -> None:
+        self._snapshots.pop(key, None)
+
+    def retain(self, keys: Collection[Hashable]) -> None:
+        """ Forgets the snapshots of keys other than keys. """
+        for key in set(self._snapshots) - set(keys):
+            del self._snapshots[key]
@@ -0,0 +1,78 @@
+import importlib.abc
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader, profiler: "ImportProfiler"):
+        self._loader = loader
+        self._profiler = profiler
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module) -> None:
+        self._profiler.enter()
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profiler.leave(module.__name__, time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    """
+    Times imports executed after install(), like python -X importtime.
+    Cumulative time of a module includes the modules it imports, self time does not.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # module -> (self time, cumulative time)
+        self.times: Dict[str, Tuple[float, float]] = {}
+        self._children: List[float] = []
+
+    def install(self) -> None:
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self) -> None:
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = _TimedLoader(spec.loader, self)
+            return spec
+        return None
+
+    def enter(self) -> None:
+        self._children.append(0.0)
+
+    def leave(self, name: str, elapsed: float) -> None:
+        children = self._children.pop()
+        self.times[name] = (elapsed - children, elapsed)
+        if self._children:
+            self._children[-1] += elapsed
+
+    def report(self, top: int = 25) -> str:
+        """ Returns the slowest top-level imports and the slowest modules by self time. """
+        total = time.perf_counter() - self.started
+        roots = [name for name in self.times if "." not in name]
+        lines = [f"Startup took {total * 1000:.1f} ms, {len(self.times)} modules imported"]
+        lines.append(f"{'cumulative ms':>14} {'self ms':>9}  top-level module")
+        for name in sorted(roots, key=lambda x: -self.times[x][1])[:top]:
+            lines.append(f"{self.times[name][1] * 1000:14.1f} {self.times[name][0] * 1000:9.1f}  {name}")
+        lines.append(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for name in sorted(self.times, key=lambda x: -self.times[x][0])[:top]:
+            lines.append(f"{self.times[name][1] * 1000:14.1f} {self.times[name][0] * 1000:9.1f}  {name}")
+        return "\n".join(lines)
@@ -2,10 +2,14 @@ import asyncio
 import argparse
 import json
 import logging
-from typing import List, Tuple, Optional
+from typing import Dict, List, Set, Tuple, Optional
 
 import date_helper
+import metrics
+from availability_matrix import AvailabilityMatrix
 from connection import Connection
+from site_registry import CampsiteInfo, SiteRegistry
+from snapshot import SnapshotStore
 
 from datetime import timedelta, datetime as dt
 from enum import Enum, auto
@@ -67,74 +71,18 @@ class CampsiteType(Enum):
         return [x.name for x in cls] + [""]
 
 
-class CampsiteInfo:
-    @classmethod
-    async def create(cls, campsite_id, capacity_rating, min_num_people, max_num_people, loop, site, campsite_type, conn, camp_id):
-        myself = cls()
-        myself._logger = logging.getLogger(cls.__class__.__name__)
-        myself.campsite_id = campsite_id
-        myself.capacity_rating = capacity_rating
-        myself.min_num_people = min_num_people
-        myself.max_num_people = max_num_people
-        myself.loop = loop
-        myself.site = site
-        myself.campsite_type = campsite_type
-        myself.rate, myself.rate_str = await myself.get_rate(await conn.get_camp_rates(camp_id), conn.start_date, conn.end_date)
-        return myself
-
-    async def get_rate(self, rates, start_date, end_date):
-        rate = {}
-        ret = (0, "NaN")
-        # look for the rate structiure
-        for r in rates['rates_list']:
-            season_start = dt.strptime(r['season_start'], '%Y-%m-%dT00:00:00Z')
-            season_end = dt.strptime(r['season_end'], '%Y-%m-%dT00:00:00Z')
-            if start_date >= season_start and end_date <= season_end:
-                rate = r
-                break
-        if not rate:
-            self._logger.warning("Could not find rate")
-            return ret
-
-        key = None
-        for k, v in rate["site_type_map"].items():
-            if v == self.campsite_type:
-                key = k
-                break
-        else:
-            self._logger.warning("Could not find rate key")
-            return ret
-
-        # There are more values, never seen them non 0/none for what I'm looking for
-        s = rate["rate_map"][key]
-        if s["per_night"]:
-            ret = (s["per_night"], f"${s['per_night']}/night")
-        elif s["per_person"]:
-            ret = (s["per_person"], f"${s['per_person']}/person")
-        elif s["group_fees"]:
-            k = list(s["group_fees"].keys())[0]
-            v = s["group_fees"][k]
-            ret = (v, f"${v}/group {k}")
-        if not ret[0]:
-            self._logger.warning("Could not find rate")
-        return ret
-
-    def __str__(self):
-        return f"  - \"{self.loop}\" - {self.site}, {self.capacity_rating} {self.min_num_people}-{self.max_num_people} ppl, {self.rate_str}"
-
-    def html(self):
-        url = Connection.campsite_url(self.campsite_id)
-        return f"  - <a href=\"{url}\">\"{self.loop}\" - {self.site}</a>, {self.capacity_rating} {self.min_num_people}-{self.max_num_people} ppl, {self.rate_str}"
-
-
 class UserRequest:
     SUCCESS_EMOJI = "🏕"
     FAILURE_EMOJI = "❌"
+    STALE_EMOJI = "⚠️"
+    LOST_EMOJI = "📉"
     SITE_INFO_THRESHOLD = 5
+    # Shared by all the user requests, requests for the same camp and dates share the CampsiteInfo
+    SITES = SiteRegistry()
 
     def __init__(self, start_date: str, end_date: str, camp_ids: List[int],
                  only_available: bool, no_overall: bool, html: bool, skip_use_type: Optional[UseType],
-                 skip_campsite_types: Optional[CampsiteType]):
+                 skip_campsite_types: Optional[CampsiteType], nights: Optional[int] = None):
         self._conn: Connection = Connection(
             date_helper.valid_date(start_date),
             date_helper.valid_date(end_date)
@@ -148,16 +96,26 @@ class UserRequest:
         self._logger = logging.getLogger(self.__class__.__name__)
         self._camp_names = {}
         self._skip_use_type = skip_use_type
+        self._skip_campsite_types = skip_campsite_types
         self._skip_campsite_types_names: List[str] = [
             x.name.upper() for x in skip_campsite_types] if skip_use_type else []
+        # Any `nights` nights in a row between start_date and end_date instead of the whole stay
+        self.nights = nights
 
     @classmethod
     def _make_user_request(cls, request_str: str, only_available: bool, no_overall: bool, html: bool,
                            skip_use_type: Optional[UseType], skip_campsite_types: Optional[CampsiteType]):  # -> UserRequest:
         dates, camp_ids_str = request_str.split(":")
+        dates, _, window = dates.partition("~")
         start_date, end_date = dates.split("..")
+        nights: Optional[int] = None
+        if window:
+            if not window.endswith("n") or not window[:-1].isdigit() or int(window[:-1]) < 1:
+                raise ValueError(f"Not a valid number of nights: '{window}', expected something like '2n'")
+            nights = int(window[:-1])
         camp_ids: List[int] = [int(x) for x in camp_ids_str.split(",")]
-        return cls(start_date, end_date, camp_ids, only_available, no_overall, html, skip_use_type, skip_campsite_types)
+        return cls(start_date, end_date, camp_ids, only_available, no_overall, html, skip_use_type,
+                   skip_campsite_types, nights)
 
     @classmethod
     def make_user_requests(cls, requests_str: str, only_available: bool,
@@ -169,39 +127,59 @@ class UserRequest:
                                               no_overall, html, skip_use_type, skip_campsite_types))
         return ret
 
-    async def get_available_sites_info(self, resp, camp_id):
-        maximum = resp["count"]
+    async def _sites_info(self, matrix: AvailabilityMatrix, rows, camp_id, start_date: Optional[dt] = None,
+                          end_date: Optional[dt] = None) -> List[CampsiteInfo]:
+        """
+        Returns CampsiteInfo of the matrix rows with the rates of start_date..end_date, the request
+        dates by default. Rates are fetched and compiled once per camp and the sites are taken from SITES.
+        """
+        if not len(rows):
+            return []
+        rate_index = await self._conn.get_camp_rate_index(camp_id)
+        with metrics.PHASE_SECONDS.time(phase="rates"):
+            return self.SITES.infos(camp_id, [matrix.sites[row] for row in rows], rate_index,
+                                    start_date or self._conn.start_date, end_date or self._conn.end_date)
+
+    async def get_available_sites_info(self, matrix: AvailabilityMatrix, camp_id):
+        maximum = matrix.count
 
         available_sites_info: List[CampsiteInfo] = []
-        num_days = (self._conn.end_date - self._conn.start_date).days
-        dates = {self._conn.end_date - timedelta(days=i) for i in range(num_days)}
-        for site in resp["campsites"].values():
-            if self._skip_use_type and site['type_of_use'] == self._skip_use_type.name:
-                continue
-            if site["campsite_type"].upper().replace(" ", "_") in self._skip_campsite_types_names:
-                continue
-            available_dates = {date_helper.date_from_str(
-                date) for date, status in site["availabilities"].items() if status == "Available"}
-            if dates.issubset(available_dates):
-                available_sites_info.append(
-                    await CampsiteInfo.create(
-                        site["campsite_id"],
-                        site["capacity_rating"],
-                        site["min_num_people"],
-                        site["max_num_people"],
-                        site["loop"],
-                        site["site"],
-                        site["campsite_type"],
-                        self._conn,
-                        camp_id
-                    )
-                )
+        # Nights are checked from the day after start_date up to end_date
+        with metrics.PHASE_SECONDS.time(phase="evaluate"):
+            rows = matrix.available_rows(
+                self._conn.start_date + timedelta(days=1),
+                self._conn.end_date,
+                self._skip_use_type.name if self._skip_use_type else None,
+                self._skip_campsite_types_names
+            )
+        for row, site_info in zip(rows, await self._sites_info(matrix, rows, camp_id)):
+            available_sites_info.append(site_info)
+            if self._logger.isEnabledFor(logging.DEBUG):
                 self._logger.debug("Available site #{}: {}".format(
-                    len(available_sites_info), json.dumps(site, indent=1)))
-        if available_sites_info:
-            self.available_at = dt.now()
+                    len(available_sites_info), json.dumps(matrix.sites[row], indent=1)))
         return maximum, available_sites_info
 
+    async def get_available_windows(self, matrix: AvailabilityMatrix, camp_id) -> Tuple[int, Dict[dt, List[CampsiteInfo]]]:
+        """
+        Returns number of sites and sites available for self.nights nights in a row by the day of arrival,
+        with the rates of each stay. Nights of a stay are checked like those of the whole request, from the
+        day after arrival up to the day of leaving, so start..end~Nn finds the same sites as start..end
+        when there are N nights between them.
+        """
+        with metrics.PHASE_SECONDS.time(phase="evaluate"):
+            windows = matrix.available_windows(
+                self._conn.start_date + timedelta(days=1),
+                self._conn.end_date,
+                self.nights,
+                self._skip_use_type.name if self._skip_use_type else None,
+                self._skip_campsite_types_names
+            )
+        ret: Dict[dt, List[CampsiteInfo]] = {}
+        for first_night, rows in windows:
+            arrival = first_night - timedelta(days=1)
+            ret[arrival] = await self._sites_info(matrix, rows, camp_id, arrival, arrival + timedelta(days=self.nights))
+        return matrix.count, ret
+
     def _process_site_availability(self, available_sites_info: List[CampsiteInfo],
                                    camp_id: int, name_of_camp: str, sites_num: int) -> List[str]:
         """ Process available_sites_info and returns list of lines ready to be printed. """
@@ -243,43 +221,219 @@ class UserRequest:
                         ret.append(str(site_info))
         return ret
 
-    async def process_request(self) -> Tuple[bool, str]:
-        out: List[str] = []
-        camps_infos, camps_names = await asyncio.gather(
-            *[
-                self._conn.get_camps_information(self._camp_ids),
-                self.camp_names()
-            ]
-        )
+    def _camp_line(self, emoji: str, camp_id: int, name_of_camp: str, text: str) -> str:
+        if self._html:
+            return "- {} <a href=\"{}\">{}</a> ({}): {}".format(
+                emoji, self._conn.camp_availability_url(camp_id), name_of_camp, camp_id, text)
+        return f"{emoji} {name_of_camp} ({camp_id}): {text}"
+
+    def _sites_lines(self, sites_info: List[CampsiteInfo], indent: str = "") -> List[str]:
+        if len(sites_info) > self.SITE_INFO_THRESHOLD:
+            return []
+        return [indent + (x.html() if self._html else str(x)) for x in sites_info]
+
+    def _process_site_changes(self, opened_sites_info: List[CampsiteInfo], lost_num: int, camp_id: int,
+                              name_of_camp: str, sites_num: int, num_available: int) -> List[str]:
+        """ Returns lines about sites that became available or were taken since the previous check. """
+        if not opened_sites_info and not lost_num:
+            return []
+        changes = []
+        if opened_sites_info:
+            changes.append(f"{len(opened_sites_info)} site(s) opened")
+        if lost_num:
+            changes.append(f"{lost_num} site(s) gone")
+        emoji = self.SUCCESS_EMOJI if opened_sites_info else self.LOST_EMOJI
+        summary = f"{', '.join(changes)}, {num_available} site(s) available out of {sites_num} site(s)"
+        return [self._camp_line(emoji, camp_id, name_of_camp, summary)] + self._sites_lines(opened_sites_info)
+
+    def _windows_lines(self, windows: Dict[dt, List[CampsiteInfo]]) -> List[str]:
+        """ Returns lines of stays grouped by the day of arrival. """
+        ret: List[str] = []
+        for start in sorted(windows):
+            leave = start + timedelta(days=self.nights)
+            ret.append(f"  - {start.date()}..{leave.date()}: {len(windows[start])} site(s)")
+            ret.extend(self._sites_lines(windows[start], "  "))
+        return ret
 
-        for camp_id in self._camp_ids:
-            camp_information = camps_infos[camp_id]
-            name_of_camp = camps_names[camp_id]
-            # TODO antipattern, but it's cached
-            sites_num, available_sites_info = await self.get_available_sites_info(camp_information, camp_id)
-            out.extend(
-                self._process_site_availability(
-                    available_sites_info, camp_id, name_of_camp, sites_num))
+    def _process_windows_availability(self, windows: Dict[dt, List[CampsiteInfo]], camp_id: int,
+                                      name_of_camp: str, sites_num: int) -> List[str]:
+        """ Same as _process_site_availability for requests looking for any self.nights nights in a row. """
+        if self._only_available and not windows:
+            return []
+        num_available = len({x.campsite_id for sites_info in windows.values() for x in sites_info})
+        summary = f"{num_available} site(s) available for {self.nights} night(s) out of {sites_num} site(s)"
+        emoji = self.SUCCESS_EMOJI if windows else self.FAILURE_EMOJI
+        return [self._camp_line(emoji, camp_id, name_of_camp, summary)] + self._windows_lines(windows)
+
+    def _process_windows_changes(self, opened_windows: Dict[dt, List[CampsiteInfo]], lost_num: int,
+                                 camp_id: int, name_of_camp: str, sites_num: int) -> List[str]:
+        """ Same as _process_site_changes for requests looking for any self.nights nights in a row. """
+        if not opened_windows and not lost_num:
+            return []
+        changes = []
+        if opened_windows:
+            changes.append(f"{sum(len(x) for x in opened_windows.values())} stay(s) opened")
+        if lost_num:
+            changes.append(f"{lost_num} stay(s) gone")
+        emoji = self.SUCCESS_EMOJI if opened_windows else self.LOST_EMOJI
+        summary = f"{', '.join(changes)} for {self.nights} night(s), out of {sites_num} site(s)"
+        return [self._camp_line(emoji, camp_id, name_of_camp, summary)] + self._windows_lines(opened_windows)
+
+    @property
+    def camp_ids(self) -> List[int]:
+        return self._camp_ids
+
+    @property
+    def key(self) -> str:
+        key = f"{self._conn.start_date.date()}..{self._conn.end_date.date()}"
+        return f"{key}~{self.nights}n" if self.nights else key
+
+    def site_dates(self) -> Set[Tuple[int, dt, dt]]:
+        """ Returns (camp_id, start_date, end_date) the sites of SITES this request uses are kept for. """
+        if not self.nights:
+            return {(camp_id, self._conn.start_date, self._conn.end_date) for camp_id in self._camp_ids}
+        # Every stay of the request has its own rates
+        arrivals = [self._conn.start_date + timedelta(days=i)
+                    for i in range((self._conn.end_date - self._conn.start_date).days - self.nights + 1)]
+        return {(camp_id, x, x + timedelta(days=self.nights)) for camp_id in self._camp_ids for x in arrivals}
+
+    def fetch_plan(self) -> Set[Tuple[int, dt]]:
+        """ Returns (camp_id, month) pairs this request needs to be processed. """
+        return self._conn.fetch_plan(self._camp_ids)
+
+    def _process_windows(self, windows: Dict[dt, List[CampsiteInfo]], camp_id: int, name_of_camp: str,
+                         sites_num: int, snapshots: Optional[SnapshotStore]) -> List[str]:
+        if snapshots is None:
+            return self._process_windows_availability(windows, camp_id, name_of_camp, sites_num)
+        opened, lost = snapshots.update(
+            (self.key, camp_id),
+            (f"{x.campsite_id}@{start.date()}" for start, sites_info in windows.items() for x in sites_info))
+        opened_windows = {}
+        for start, sites_info in windows.items():
+            opened_sites_info = [x for x in sites_info if f"{x.campsite_id}@{start.date()}" in opened]
+            if opened_sites_info:
+                opened_windows[start] = opened_sites_info
+        return self._process_windows_changes(opened_windows, len(lost), camp_id, name_of_camp, sites_num)
+
+    def _process_stale_camp(self, camp_id: int, name_of_camp: str, error: Exception) -> str:
+        """ Returns a line telling that camp_id could not be evaluated this time. """
+        self._logger.warning(f"Could not evaluate {camp_id}: {error}")
+        return self._camp_line(self.STALE_EMOJI, camp_id, name_of_camp, "stale, could not get availability")
+
+    async def process_request(self, matrices: Optional[Dict[int, AvailabilityMatrix]] = None,
+                              tolerate_failures: bool = False,
+                              snapshots: Optional[SnapshotStore] = None) -> Tuple[bool, str]:
+        """
+        Processes the request, matrices are AvailabilityMatrix.by_camp of a prefetched fetch_plan.
+        With tolerate_failures camps that could not be fetched or evaluated are reported as stale
+        instead of failing the whole request.
+        With snapshots only sites that opened or were taken since the previous call are reported.
+        """
+        if matrices is None:
+            months_info, camps_names = await asyncio.gather(
+                *[
+                    self._conn.get_planned_months(self.fetch_plan(), return_exceptions=tolerate_failures),
+                    self.camp_names(tolerate_failures)
+                ]
+            )
+            with metrics.PHASE_SECONDS.time(phase="merge"):
+                matrices = AvailabilityMatrix.by_camp(months_info)
+        else:
+            camps_names = await self.camp_names(tolerate_failures)
+        return self.render(await self.evaluate(matrices), camps_names, tolerate_failures, snapshots)
+
+    def for_camps(self, camp_ids: List[int]) -> dict:
+        """ Returns make_user_requests arguments of the same request limited to camp_ids. """
+        return {
+            "requests_str": f"{self.key}:{','.join(str(x) for x in camp_ids)}",
+            "only_available": self._only_available,
+            "no_overall": self._no_overall,
+            "html": self._html,
+            "skip_use_type": self._skip_use_type,
+            "skip_campsite_types": self._skip_campsite_types,
+        }
+
+    async def evaluate(self, matrices: Dict[int, AvailabilityMatrix],
+                       camp_ids: Optional[List[int]] = None) -> Dict[int, object]:
+        """
+        Evaluates camp_ids (all the camps of the request by default) on their matrices. Returns camp_id ->
+        (sites number, available sites info or windows of self.nights), or the exception the camp failed with.
+        """
+        ret = {}
+        for camp_id in self._camp_ids if camp_ids is None else camp_ids:
+            matrix = matrices[camp_id]
+            try:
+                if isinstance(matrix, Exception):
+                    raise matrix
+                if self.nights:
+                    ret[camp_id] = await self.get_available_windows(matrix, camp_id)
+                else:
+                    # TODO antipattern, but it's cached
+                    ret[camp_id] = await self.get_available_sites_info(matrix, camp_id)
+            except Exception as e:
+                ret[camp_id] = e
+        return ret
 
+    def render(self, results: Dict[int, object], camps_names: Dict[int, str], tolerate_failures: bool = False,
+               snapshots: Optional[SnapshotStore] = None) -> Tuple[bool, str]:
+        """ Returns (something is available, text) of evaluate results of all the camps of the request. """
+        out: List[str] = []
+        stale: List[str] = []
+        for camp_id in self._camp_ids:
+            camp_out, camp_stale = self.render_camp(
+                camp_id, results[camp_id], camps_names[camp_id], tolerate_failures, snapshots)
+            out.extend(camp_out)
+            stale.extend(camp_stale)
+        return self.compose(out, stale, snapshots)
+
+    def render_camp(self, camp_id: int, result, name_of_camp: str, tolerate_failures: bool = False,
+                    snapshots: Optional[SnapshotStore] = None,
+                    checked_at: Optional[dt] = None) -> Tuple[List[str], List[str]]:
+        """ Returns (lines, stale lines) of the evaluate result of one camp, checked at checked_at or now. """
+        if isinstance(result, Exception):
+            if not tolerate_failures:
+                raise result
+            return [], [self._process_stale_camp(camp_id, name_of_camp, result)]
+        sites_num, found = result
+        if found:
+            self.available_at = checked_at or dt.now()
+        if self.nights:
+            return self._process_windows(found, camp_id, name_of_camp, sites_num, snapshots), []
+        available_sites_info = found
+        if snapshots is None:
+            return self._process_site_availability(available_sites_info, camp_id, name_of_camp, sites_num), []
+        opened, lost = snapshots.update(
+            (self.key, camp_id), (x.campsite_id for x in available_sites_info))
+        return self._process_site_changes(
+            [x for x in available_sites_info if x.campsite_id in opened], len(lost),
+            camp_id, name_of_camp, sites_num, len(available_sites_info)), []
+
+    def compose(self, out: List[str], stale: List[str],
+                snapshots: Optional[SnapshotStore] = None) -> Tuple[bool, str]:
+        """ Returns (something is available, text) of render_camp lines with the overall line. """
         result = ""
         availabilities: bool = bool(out)
         if not self._no_overall:
-            if availabilities:
+            if snapshots is not None:
+                tmpl = "Availability changed from {} to {}:\n" if availabilities else "No changes from {} to {}\n"
+            elif availabilities:
                 tmpl = "There are campsites available from {} to {}!!! \n"
             else:
                 tmpl = "There are no campsites available from {} to {} :(\n"
             result = tmpl.format(
                 self._conn.start_date.strftime(date_helper.INPUT_DATE_FORMAT),
-                self._conn.end_date.strftime(date_helper.INPUT_DATE_FORMAT),
+                self._conn.end_date.strftime(date_helper.INPUT_DATE_FORMAT)
+                + (f" for any {self.nights} night(s)" if self.nights else ""),
             )
 
-        result += "\n".join(out)
-        if out:
+        result += "\n".join(out + stale)
+        if out or stale:
             result += "\n"
         return availabilities, result
 
     async def get_camps_names(self) -> str:
-        out = f"Looking for a place from {self._conn.start_date.date()} to {self._conn.end_date.date()} in:\n"
+        nights = f" for any {self.nights} night(s)" if self.nights else ""
+        out = f"Looking for a place from {self._conn.start_date.date()} to {self._conn.end_date.date()}{nights} in:\n"
         camp_names = await self.camp_names()
         for camp_id, camp_name in camp_names.items():
             if self._html:
@@ -288,7 +442,12 @@ class UserRequest:
                 out += f"- {camp_name}\n"
         return out
 
-    async def camp_names(self):
+    async def camp_names(self, tolerate_failures: bool = False):
         if not self._camp_names:
-            self._camp_names = await self._conn.get_camps_names(self._camp_ids)
+            camp_names = await self._conn.get_camps_names(self._camp_ids, return_exceptions=tolerate_failures)
+            if not any(isinstance(x, Exception) for x in camp_names.values()):
+                self._camp_names = camp_names
+            else:
+                # Fall back to ids, the names will be fetched again next time
+                return {k: str(k) if isinstance(v, Exception) else v for k, v in camp_names.items()}
         return self._camp_names
@@ -0,0 +1,103 @@
+import datetime
+import logging
+from typing import List, Optional
+
+from notifications import NotificationQueue, Sink, make_sinks
+from snapshot import SnapshotStore
+from user_request import UserRequest, UseType, CampsiteType
+
+
+class Watch:
+    """
+    User requests of one user: their filters, where to send the results to and what was
+    already reported. Watches of a Crawler share fetches, caches and connections.
+    """
+    # Settings a watch can be created with, see from_dict
+    FIELDS = ("id", "request", "only_available", "no_overall", "html", "only_changes", "skip_use_type",
+              "skip_campsite_types", "telegram_token", "telegram_chat_id", "webhook_url", "notify_file",
+              "notify_batch_window")
+    # The webhook url usually carries its secret in the path or the query
+    SECRET_FIELDS = ("telegram_token", "webhook_url")
+    BOOL_FIELDS = ("only_available", "no_overall", "html", "only_changes")
+
+    def __init__(self, watch_id: str, request_str: str, only_available: bool = False, no_overall: bool = False,
+                 html: bool = False, skip_use_type: Optional[UseType] = None,
+                 skip_campsite_types: Optional[List[CampsiteType]] = None, sinks: Optional[List[Sink]] = None,
+                 notify_batch_window: float = 2, only_changes: bool = False, config: Optional[dict] = None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.id = watch_id
+        self.request_str = request_str
+        self.user_requests = UserRequest.make_user_requests(
+            request_str, only_available, no_overall, html, skip_use_type, skip_campsite_types)
+        self.snapshots: Optional[SnapshotStore] = SnapshotStore() if only_changes else None
+        self.notifications = NotificationQueue(sinks or make_sinks(), notify_batch_window)
+        self.config = config if config is not None else {"id": watch_id, "request": request_str}
+
+    @classmethod
+    def from_dict(cls, config: dict, defaults: Optional[dict] = None) -> "Watch":
+        """
+        Creates a watch out of FIELDS, the missing ones are taken from defaults.
+        skip_use_type and skip_campsite_types are names as on the command line,
+        skip_campsite_types is a list or a comma separated string.
+        Raises ValueError if the config is not valid.
+        """
+        unknown = set(config) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown watch settings: {', '.join(sorted(unknown))}")
+        if not config.get("id") or not config.get("request"):
+            raise ValueError("A watch needs an id and a request")
+        not_bool = [x for x in cls.BOOL_FIELDS if x in config and not isinstance(config[x], bool)]
+        if not_bool:
+            # bool("false") is True
+            raise ValueError(f"Expected true or false for: {', '.join(not_bool)}")
+        merged = dict(defaults or {})
+        merged.update(config)
+        try:
+            skip_use_type = merged.get("skip_use_type")
+            if isinstance(skip_use_type, str):
+                skip_use_type = UseType.validate(skip_use_type)
+            skip_campsite_types = merged.get("skip_campsite_types")
+            if isinstance(skip_campsite_types, list):
+                skip_campsite_types = ",".join(x if isinstance(x, str) else x.name for x in skip_campsite_types)
+            if isinstance(skip_campsite_types, str):
+                skip_campsite_types = CampsiteType.validate_multi(skip_campsite_types)
+            html = bool(merged.get("html", False))
+            sinks = make_sinks(merged.get("telegram_token"), merged.get("telegram_chat_id"), html,
+                               merged.get("webhook_url"), merged.get("notify_file"))
+            return cls(str(merged["id"]), merged["request"], bool(merged.get("only_available", False)),
+                       bool(merged.get("no_overall", False)), html, skip_use_type, skip_campsite_types, sinks,
+                       float(merged.get("notify_batch_window", 2)), bool(merged.get("only_changes", False)),
+                       dict(config))
+        except Exception as e:
+            # argparse.ArgumentTypeError of the enums, a malformed request string
+            raise ValueError(f"Not a valid watch {config.get('id')}: {e}")
+
+    def to_dict(self) -> dict:
+        """ Returns the config of the watch without secrets. """
+        ret = {k: ("***" if k in self.SECRET_FIELDS else v) for k, v in self.config.items()}
+        ret["user_requests"] = len(self.user_requests)
+        return ret
+
+    def user_requests_in_future(self, today: Optional[datetime.date] = None) -> List[UserRequest]:
+        """ Returns the requests starting after today, the current date by default. """
+        tomorrow = datetime.datetime.combine(
+            (today or datetime.date.today()) + datetime.timedelta(days=1),
+            datetime.datetime.min.time()
+        )
+        return [x for x in self.user_requests if datetime.datetime.strptime(x.start_date, '%Y-%m-%d') >= tomorrow]
+
+    def inherit(self, previous: "Watch") -> None:
+        """
+        Takes over what previous, an older version of the watch, already reported: snapshots of the
+        requests and camps the watch still has and available_at of the very same requests.
+        """
+        if self.snapshots is not None and previous.snapshots is not None:
+            self.snapshots = previous.snapshots
+            self.snapshots.retain({(x.key, camp_id) for x in self.user_requests for camp_id in x.camp_ids})
+        available_at = {(x.key, frozenset(x.camp_ids)): x.available_at for x in previous.user_requests}
+        for x in self.user_requests:
+            x.available_at = available_at.get((x.key, frozenset(x.camp_ids)), x.available_at)
+
+    def notify(self, message: str) -> None:
+        """ Queues the message for delivery, never waits for it. """
+        self.notifications.put(message)
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+class WatchFile:
+    """
+    Watches of a Crawler kept in a JSON or YAML file, a list of Watch.FIELDS objects or
+    {"watches": [...]}:
+
+        {"watches": [{"id": "alice", "request": "2020-08-14..2020-08-16:232447", "only_changes": true,
+                      "webhook_url": "https://example.com/hook"}]}
+
+    The file is reloaded when its mtime or size changes and only the watches added, removed or changed
+    are replaced. Unchanged watches keep their snapshots, available_at and queued messages, a changed
+    one takes over what Watch.inherit allows, and the fetch caches are shared by camps, so editing the
+    file costs no warm-up. A file that can not be loaded is logged and the current watches are kept.
+    YAML files need PyYAML.
+    """
+
+    def __init__(self, crawler, path: str, check_every: float = 5):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._crawler = crawler
+        self.path = path
+        self.check_every = check_every
+        self._configs: Dict[str, dict] = {}
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _file_stamp(self) -> Tuple[int, int]:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> List[dict]:
+        """ Returns the watch configs of the file, raises ValueError if it is not valid. """
+        with open(self.path) as f:
+            text = f.read()
+        if self.path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(f"PyYAML is needed to read {self.path}: pip install pyyaml")
+            try:
+                data = yaml.safe_load(text)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Not valid YAML in {self.path}: {e}")
+        else:
+            try:
+                data = json.loads(text)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Not valid JSON in {self.path}: {e}")
+        if isinstance(data, dict):
+            data = data.get("watches")
+        if not isinstance(data, list) or not all(isinstance(x, dict) for x in data):
+            raise ValueError(f"Expected a list of watches or {{\"watches\": [...]}} in {self.path}")
+        ids = [x.get("id") for x in data]
+        duplicates = sorted({str(x) for x in ids if ids.count(x) > 1})
+        if duplicates:
+            raise ValueError(f"Duplicate watch ids in {self.path}: {', '.join(duplicates)}")
+        return data
+
+    def load(self) -> None:
+        """ Adds the watches of the file, raises ValueError if any of them is not valid. """
+        self._stamp = self._file_stamp()
+        watches = [self._crawler.make_watch(x) for x in self._read()]
+        for watch in watches:
+            self._crawler.add_watch(watch)
+            self._configs[watch.id] = watch.config
+        self._logger.info(f"Loaded {len(watches)} watches from {self.path}")
+
+    async def reload(self) -> bool:
+        """ Applies the changes of the file if it changed since the last time, returns True if it did. """
+        try:
+            stamp = self._file_stamp()
+            if stamp == self._stamp:
+                return False
+            self._stamp = stamp
+            configs = {str(x.get("id")): x for x in self._read()}
+            watches = {x.id: x for x in [self._crawler.make_watch(config) for watch_id, config in configs.items()
+                                         if self._configs.get(watch_id) != config]}
+            for watch_id, watch in watches.items():
+                current = self._crawler.watch(watch_id)
+                if current is not None and watch_id not in self._configs:
+                    raise ValueError(f"There is a watch {watch_id} not from {self.path} already")
+        except (OSError, ValueError) as e:
+            self._logger.error(f"Could not reload {self.path}, keeping the current watches: {e}")
+            return True
+        removed = [x for x in self._configs if x not in configs]
+        added = [x for x in watches if x not in self._configs]
+        for watch_id in removed + list(watches):
+            previous = await self._crawler.remove_watch(watch_id)
+            if previous is not None and watch_id in watches:
+                watches[watch_id].inherit(previous)
+            self._configs.pop(watch_id, None)
+        for watch_id, watch in watches.items():
+            self._crawler.add_watch(watch)
+            self._configs[watch_id] = watch.config
+        self._logger.info(f"Reloaded {self.path}: {len(added)} watches added, {len(watches) - len(added)} changed, "
+                          f"{len(removed)} removed, {len(self._configs) - len(watches)} unchanged")
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_every)
+            await self.reload()
+
+    async def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None